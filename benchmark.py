@@ -0,0 +1,623 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import fikTools.excel
+import fikTools.file
+import fikTools.log
+import fikTools.pdf
+import gc
+import multiprocessing
+import os
+import platform
+import reportlab
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from openpyxl import Workbook
+from reportlab.platypus import Paragraph
+
+
+# Synthetic configuration, so that the benchmarks can run without any project settings
+
+_fonts_directory = os.path.join(os.path.dirname(reportlab.__file__), 'fonts')
+
+_fonts_list = {
+    'Default': {
+        '': 'Vera.ttf',
+        'Bold': 'VeraBd.ttf',
+        'BoldItalic': 'VeraBI.ttf',
+        'Italic': 'VeraIt.ttf',
+    },
+}
+
+_font_sizes = {
+    '': 10,
+    'small': 8,
+    'large': 14,
+}
+
+
+def _styles():
+    styles = {
+        'default': {},
+        'table_of_contents': {},
+    }
+
+    for code in ['body', 'doc_title', 'doc_subtitle', 'h1', 'h2', 'h3']:
+        styles['default'][code] = {'font': 'Default', 'fontsize': 10}
+
+    for code in ['level1', 'level2', 'level3', 'level4']:
+        styles['table_of_contents'][code] = {'font': 'Default', 'fontsize': 10}
+
+    return styles
+
+
+def _init_pdf():
+    fikTools.pdf.init(font_sizes=_font_sizes, fonts_list=_fonts_list, fonts_directory=_fonts_directory, styles=_styles(), leading=1.2, space_before=0, space_after=0.6)
+
+
+# Measurements
+
+def _time(function, repeat):
+    best = None
+
+    for i in range(repeat):
+        gc.collect()
+
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def _measure(function, items, repeat):
+    # Best time over the repeats, then one more run under tracemalloc for the peak memory (tracing slows the code down)
+
+    seconds = _time(function, repeat)
+
+    gc.collect()
+
+    tracemalloc.start()
+    function()
+    ignore, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'items': items,
+        'seconds': seconds,
+        'items_per_second': items / seconds if seconds > 0 else 0,
+        'peak_memory': peak_memory,
+    }
+
+
+def _count_filesystem_calls(function):
+    # Counts the calls to the os functions which hit the file system (os.path.isfile and the like go through os.stat)
+
+    counts = {}
+    originals = {}
+
+    def counted(name, original):
+        def wrapper(*args, **kwargs):
+            counts[name] = counts.get(name, 0) + 1
+            return original(*args, **kwargs)
+
+        return wrapper
+
+    for name in ['stat', 'lstat', 'listdir', 'scandir']:
+        originals[name] = getattr(os, name)
+        setattr(os, name, counted(name, originals[name]))
+
+    try:
+        function()
+
+    finally:
+        for name in originals.keys():
+            setattr(os, name, originals[name])
+
+    return sum(counts.values())
+
+
+# Fixtures
+
+def _table_data(rows, columns, text_override):
+    data = []
+
+    for r in range(rows):
+        row = []
+
+        for c in range(columns):
+            row.append(fikTools.pdf.table_entry(
+                'row {} column {}'.format(r, c),
+                style='body',
+                background='#cccccc' if r % 2 == 0 else '#ffffff',
+                text_override='{}:{}'.format(r, c) if text_override else None,
+            ))
+
+        data.append(row)
+
+    return data
+
+
+def _story(paragraphs):
+    story = []
+
+    for i in range(paragraphs):
+        if i % 10 == 0:
+            story.append(Paragraph('Heading {}'.format(i // 10), fikTools.pdf.get_style('h1')))
+
+        story.append(Paragraph('Paragraph {} '.format(i) * 40, fikTools.pdf.get_style('body')))
+
+    return story
+
+
+def _workbook(rows, columns):
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'data'
+
+    ws.cell(row=1, column=2).value = '3,1:{},{}'.format(rows + 2, columns)
+
+    for r in range(3, rows + 3):
+        for c in range(1, columns + 1):
+            ws.cell(row=r, column=c).value = 'r{}c{}'.format(r, c) if c % 2 else r * c
+
+    return wb
+
+
+def _directory_tree(directory, depth, width, files):
+    # width subdirectories per directory, down to depth levels, with files in every directory
+    # Returns the number of files created
+
+    count = 0
+
+    for f in range(files):
+        fikTools.file.save_text_file(fikTools.file.join(directory, 'file_{}.{}'.format(f, 'txt' if f % 2 else 'png')), '')
+        count += 1
+
+    if depth > 0:
+        for d in range(width):
+            subdirectory = fikTools.file.join(directory, 'directory_{}'.format(d))
+            fikTools.file.mkdir(subdirectory)
+            count += _directory_tree(subdirectory, depth - 1, width, files)
+
+    return count
+
+
+# Benchmarks - each returns a dictionary of measurements
+
+def benchmark_pdf_get_style(repeat=3, calls=50000):
+    _init_pdf()
+
+    def run():
+        for i in range(calls):
+            fikTools.pdf.get_style(preset='body' if i % 2 else 'h1', bold=(i % 3 == 0), foreground='#000000' if i % 5 else '#ff0000')
+
+    return {'pdf.get_style': _measure(run, calls, repeat)}
+
+
+def benchmark_pdf_table(repeat=3, rows=2000, columns=10):
+    # Compares pdf.table with pdf.table_from_rows, with and without paragraph creation (text override cells)
+
+    _init_pdf()
+
+    result = {}
+
+    for text_override in [False, True]:
+        data = _table_data(rows, columns, text_override)
+
+        for function in [fikTools.pdf.table, fikTools.pdf.table_from_rows]:
+            result['pdf.{}{}'.format(function.__name__, ' (text override)' if text_override else '')] = _measure(lambda: function(data), rows * columns, repeat)
+
+    return result
+
+
+def _story_fingerprint(paragraphs):
+    # Run in fresh processes, to check that the build cache recognises the same story from one run to the next
+
+    _init_pdf()
+
+    return fikTools.pdf._story_fingerprint(_story(paragraphs), {})
+
+
+def benchmark_pdf_build_pdf(repeat=3, paragraphs=500):
+    _init_pdf()
+
+    fingerprints = set()
+
+    for i in range(2):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            fingerprints.add(executor.submit(_story_fingerprint, paragraphs).result())
+
+    if len(fingerprints) != 1:
+        raise Exception('The fingerprint of the same story differs between processes, so the build cache never applies')
+
+    result = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for create_toc in [False, True]:
+            target_file = fikTools.file.join(directory, 'benchmark.pdf')
+
+            result['pdf.build_pdf{}'.format(' (toc)' if create_toc else '')] = _measure(
+                lambda: fikTools.pdf.build_pdf(target_file, _story(paragraphs), 'A4', styles_for_toc=[['h1', 0]], create_toc=create_toc),
+                paragraphs,
+                repeat
+            )
+
+        cache_directory = fikTools.file.join(directory, 'cache')
+
+        fikTools.pdf.build_pdf(target_file, _story(paragraphs), 'A4', create_toc=False, cache_directory=cache_directory)
+
+        result['pdf.build_pdf (unchanged, cached)'] = _measure(
+            lambda: fikTools.pdf.build_pdf(target_file, _story(paragraphs), 'A4', create_toc=False, cache_directory=cache_directory),
+            paragraphs,
+            repeat
+        )
+
+    return result
+
+
+def benchmark_excel_set_borders(repeat=3, rows=500, columns=40):
+    ws = _workbook(rows, columns)['data']
+
+    return {'excel.set_borders': _measure(lambda: fikTools.excel.set_borders(ws, 3, rows + 2, 1, columns), rows * columns, repeat)}
+
+
+def _config_module(settings):
+    # Stand-in for the host project's config module, which excelImport imports
+
+    config = types.ModuleType('config')
+    config.get_config = lambda key: settings[key]
+
+    return config
+
+
+def benchmark_excel_import_process_excel(repeat=3, rows=5000, columns=20):
+    with tempfile.TemporaryDirectory() as directory:
+        # The host project's config module is used if there is one, a stub with fixture settings otherwise
+
+        try:
+            import config
+
+        except ImportError:
+            sys.modules['config'] = _config_module({
+                'data_types_reference_directory': directory,
+                'load_first_reference_directory': directory,
+            })
+
+        import fikTools.excelImport
+
+        wb = _workbook(rows, columns)
+
+        table_info = fikTools.excelImport.get_table_info(wb, 'data')
+        csv_file = fikTools.file.join(directory, 'data.csv')
+
+        return {'excelImport.process_excel': _measure(lambda: fikTools.excelImport.process_excel(wb, table_info, csv_file), rows * columns, repeat)}
+
+
+def benchmark_file_get_files(repeat=3, files=20000):
+    with tempfile.TemporaryDirectory() as directory:
+        count = _directory_tree(directory, 0, 0, files)
+
+        result = {}
+
+        for function in [fikTools.file.get_files, fikTools.file.get_directories, fikTools.file.get_files_and_directories]:
+            result['file.{}'.format(function.__name__)] = _measure(lambda: function(directory), count, repeat)
+            result['file.{}'.format(function.__name__)]['filesystem_calls'] = _count_filesystem_calls(lambda: function(directory))
+
+        return result
+
+
+def benchmark_file_get_files_recursively(repeat=3, depth=4, width=6, files=10):
+    with tempfile.TemporaryDirectory() as directory:
+        count = _directory_tree(directory, depth, width, files)
+
+        result = {}
+
+        for name, function in [
+            ('file.get_files_recursively', lambda: fikTools.file.get_files_recursively(directory, regexp=r'.*\.png$')),
+            ('file.iter_files_recursively', lambda: list(fikTools.file.iter_files_recursively(directory, regexp=r'.*\.png$'))),
+            ('file.get_files_recursively_parallel', lambda: fikTools.file.get_files_recursively_parallel(directory, regexp=r'.*\.png$', ordered=True)),
+        ]:
+            result[name] = _measure(function, count, repeat)
+            result[name]['filesystem_calls'] = _count_filesystem_calls(function)
+
+        return result
+
+
+def _json_data(records):
+    return {'data': {'record {}'.format(i): {'name': 'Record {} – é'.format(i), 'value': i, 'ratio': i / 7, 'tags': ['a', 'b', 'c'], 'ok': i % 2 == 0} for i in range(records)}}
+
+
+def benchmark_file_json(repeat=3, records=50000):
+    data = _json_data(records)
+
+    backend = fikTools.file.get_json_backend()
+
+    result = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for candidate in ['json', 'ujson', 'orjson']:
+            try:
+                fikTools.file.set_json_backend(candidate)
+
+            except Exception:
+                continue
+
+            for compact in [False, True]:
+                target_file = fikTools.file.join(directory, 'data.json')
+                name = '{} {}'.format(candidate, 'compact' if compact else 'pretty')
+
+                result['file.save_json_file ({})'.format(name)] = _measure(lambda: fikTools.file.save_json_file(target_file, data, compact=compact), records, repeat)
+                result['file.load_json_file ({})'.format(name)] = _measure(lambda: fikTools.file.load_json_file(target_file), records, repeat)
+
+        # Cached binary copy (see file.enable_json_cache)
+
+        fikTools.file.set_json_backend(backend)
+
+        target_file = fikTools.file.join(directory, 'data.json')
+        fikTools.file.save_json_file(target_file, data)
+
+        fikTools.file.enable_json_cache()
+        fikTools.file.load_json_file(target_file)
+
+        result['file.load_json_file (cached)'] = _measure(lambda: fikTools.file.load_json_file(target_file), records, repeat)
+
+        fikTools.file.disable_json_cache()
+
+    return result
+
+
+def _jsonl_summary(record):
+    return record['value'] if record['ok'] else 0
+
+
+def benchmark_file_jsonl(repeat=3, records=200000):
+    def records_generator():
+        for i in range(records):
+            yield {'name': 'Record {} – é'.format(i), 'value': i, 'ratio': i / 7, 'tags': ['a', 'b', 'c'], 'ok': i % 2 == 0}
+
+    result = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        target_file = fikTools.file.join(directory, 'data.jsonl')
+
+        def index():
+            fikTools.file._jsonl_indexes.clear()
+            fikTools.file.index_jsonl_file(target_file)
+
+        def random_access():
+            for i in range(0, records, records // 1000):
+                fikTools.file.load_jsonl_record(target_file, i)
+
+        result['file.save_jsonl_file'] = _measure(lambda: fikTools.file.save_jsonl_file(target_file, records_generator()), records, repeat)
+        result['file.iter_jsonl_file'] = _measure(lambda: sum(1 for r in fikTools.file.iter_jsonl_file(target_file)), records, repeat)
+        result['file.iter_jsonl_file (function)'] = _measure(lambda: sum(_jsonl_summary(r) for r in fikTools.file.iter_jsonl_file(target_file)), records, repeat)
+        result['file.iter_jsonl_file_parallel (function)'] = _measure(lambda: sum(fikTools.file.iter_jsonl_file_parallel(target_file, function=_jsonl_summary, chunk_size=records // 16)), records, repeat)
+        result['file.index_jsonl_file'] = _measure(index, records, repeat)
+        result['file.load_jsonl_record (1000 records)'] = _measure(random_access, 1000, repeat)
+
+    return result
+
+
+def benchmark_file_csv(repeat=3, rows=200000):
+    def rows_generator():
+        for i in range(rows):
+            yield [i, 'Row {}'.format(i), i / 7, 'a, b']
+
+    result = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        target_file = fikTools.file.join(directory, 'data.csv')
+
+        result['file.save_csv_file (list)'] = _measure(lambda: fikTools.file.save_csv_file(target_file, list(rows_generator())), rows, repeat)
+        result['file.save_csv_file (generator)'] = _measure(lambda: fikTools.file.save_csv_file(target_file, rows_generator()), rows, repeat)
+        result['file.load_csv_file'] = _measure(lambda: fikTools.file.load_csv_file(target_file), rows, repeat)
+        result['file.iter_csv_file'] = _measure(lambda: sum(1 for r in fikTools.file.iter_csv_file(target_file)), rows, repeat)
+        result['file.iter_csv_file (typed, chunks)'] = _measure(lambda: sum(len(c) for c in fikTools.file.iter_csv_file(target_file, types=[int, None, float], chunk_size=50000)), rows, repeat)
+
+    return result
+
+
+def benchmark_file_save_many(repeat=3, files=1000):
+    # Many small files, as written by a parallel build: without fsync, with one fsync per file and with fsync_batch
+
+    data = {'name': 'Record', 'value': 1}
+
+    def save_files(directory):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda i: fikTools.file.save_json_file(fikTools.file.join(directory, '{}.json'.format(i)), data), range(files)))
+
+    def save_files_batch(directory):
+        with fikTools.file.fsync_batch():
+            save_files(directory)
+
+    result = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        result['file.save_json_file (no fsync)'] = _measure(lambda: save_files(directory), files, repeat)
+
+        fikTools.file.enable_fsync()
+        result['file.save_json_file (fsync)'] = _measure(lambda: save_files(directory), files, repeat)
+        fikTools.file.disable_fsync()
+
+        result['file.save_json_file (fsync_batch)'] = _measure(lambda: save_files_batch(directory), files, repeat)
+
+    return result
+
+
+def benchmark_file_copy_dir(repeat=3, files=2000, size=65536):
+    # The default (one file at a time, as before) against parallel copies, hardlinks and an update of an unchanged copy
+
+    content = os.urandom(size)
+
+    result = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = fikTools.file.join(directory, 'source')
+        fikTools.file.mkdir(source)
+
+        for i in range(files):
+            with open(fikTools.file.join(source, 'file {}.bin'.format(i)), 'wb') as target:
+                target.write(content)
+
+        def copy_dir(name, **kwargs):
+            destination = fikTools.file.join(directory, name)
+
+            def run():
+                if not kwargs.get('skip_unchanged'):
+                    shutil.rmtree(destination, ignore_errors=True)
+
+                fikTools.file.copy_dir(source, destination, **kwargs)
+
+            return run
+
+        result['file.copy_dir'] = _measure(copy_dir('copy'), files, repeat)
+        result['file.copy_dir (8 workers)'] = _measure(copy_dir('parallel', workers=8), files, repeat)
+        result['file.copy_dir (hardlink, 8 workers)'] = _measure(copy_dir('hardlink', workers=8, link='hardlink'), files, repeat)
+        result['file.copy_dir (reflink, 8 workers)'] = _measure(copy_dir('reflink', workers=8, link='reflink'), files, repeat)
+        result['file.copy_dir (unchanged, 8 workers)'] = _measure(copy_dir('unchanged', workers=8, skip_unchanged=True), files, repeat)
+
+    return result
+
+
+def benchmark_file_get_numbered_file_name(repeat=3, files=20000, names=100):
+    # Allocating names in a directory already holding many numbered files
+
+    result = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(files):
+            with open(fikTools.file.join(directory, 'log_{}.txt'.format(i + 1)), 'w'):
+                pass
+
+        # Reserving (as save_log does) keeps the index up to date, which the plain lookups then use
+
+        result['file.get_numbered_file_name (reserve)'] = _measure(lambda: [fikTools.file.get_numbered_file_name(directory, 'log.txt', reserve=True) for i in range(names)], names, repeat)
+        result['file.get_numbered_file_name'] = _measure(lambda: [fikTools.file.get_numbered_file_name(directory, 'log.txt') for i in range(names)], names, repeat)
+
+    return result
+
+
+def benchmark_log_debug(repeat=3, messages=100000):
+    # Debug messages filtered out (formatted eagerly, or deferred with args) and logged
+
+    def debug(trace_level, deferred):
+        for i in range(messages):
+            if deferred:
+                fikTools.log.debug('message {} of {}', args=(i, messages), trace_level=trace_level, file=__file__, send_to_screen=False)
+            else:
+                fikTools.log.debug('message {} of {}'.format(i, messages), trace_level=trace_level, file=__file__, send_to_screen=False)
+
+    fikTools.log.set_trace_levels(['benchmark'])
+
+    result = {
+        'log.debug (filtered out)': _measure(lambda: debug('other', False), messages, repeat),
+        'log.debug (filtered out, deferred)': _measure(lambda: debug('other', True), messages, repeat),
+        'log.debug (logged)': _measure(lambda: debug('benchmark', True), messages, repeat),
+    }
+
+    fikTools.log.set_trace_levels([])
+
+    return result
+
+
+_benchmarks = {
+    'pdf.get_style': benchmark_pdf_get_style,
+    'pdf.table': benchmark_pdf_table,
+    'pdf.build_pdf': benchmark_pdf_build_pdf,
+    'excel.set_borders': benchmark_excel_set_borders,
+    'excelImport.process_excel': benchmark_excel_import_process_excel,
+    'file.get_files': benchmark_file_get_files,
+    'file.get_files_recursively': benchmark_file_get_files_recursively,
+    'file.get_numbered_file_name': benchmark_file_get_numbered_file_name,
+    'file.copy_dir': benchmark_file_copy_dir,
+    'file.csv': benchmark_file_csv,
+    'file.json': benchmark_file_json,
+    'file.jsonl': benchmark_file_jsonl,
+    'file.save_many': benchmark_file_save_many,
+    'log.debug': benchmark_log_debug,
+}
+
+
+def get_benchmarks():
+    return _benchmarks.keys()
+
+
+def run_benchmarks(names=None, repeat=3):
+    results = {}
+
+    for name in (names if names else _benchmarks.keys()):
+        results.update(_benchmarks[name](repeat=repeat))
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    # Returns the measurements which are more than tolerance (as a fraction) slower or bigger than the baseline:
+    # name -> {metric: (baseline value, current value)}
+
+    regressions = {}
+
+    for name, measurement in results['results'].items():
+        if name not in baseline['results'].keys() or 'skipped' in measurement or 'skipped' in baseline['results'][name]:
+            continue
+
+        reference = baseline['results'][name]
+
+        for metric in ['seconds', 'peak_memory', 'filesystem_calls']:
+            if metric in reference.keys() and metric in measurement.keys() and reference[metric] > 0 and measurement[metric] > reference[metric] * (1 + tolerance):
+                regressions.setdefault(name, {})[metric] = (reference[metric], measurement[metric])
+
+    return regressions
+
+
+def show_results(results):
+    for name, measurement in results['results'].items():
+        if 'skipped' in measurement:
+            print('{}: skipped ({})'.format(name, measurement['skipped']))
+        else:
+            print('{}: {:.3f}s, {:.0f} items/s, peak memory {:.1f} MB{}'.format(
+                name,
+                measurement['seconds'],
+                measurement['items_per_second'],
+                measurement['peak_memory'] / 1e6,
+                ', {} file system calls'.format(measurement['filesystem_calls']) if 'filesystem_calls' in measurement else ''
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fikTools benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run (default: all of {})'.format(', '.join(_benchmarks.keys())))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='JSON file to save the results to')
+    parser.add_argument('--baseline', help='JSON file with previous results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    arguments = parser.parse_args()
+
+    results = run_benchmarks(arguments.benchmarks, repeat=arguments.repeat)
+
+    show_results(results)
+
+    if arguments.save is not None:
+        fikTools.file.save_json_file(arguments.save, results, create_directories=True)
+
+    if arguments.baseline is not None:
+        regressions = compare_results(results, fikTools.file.load_json_file(arguments.baseline), tolerance=arguments.tolerance)
+
+        for name in sorted(regressions.keys()):
+            for metric, (reference, current) in regressions[name].items():
+                print('REGRESSION {} {}: {:.3f} -> {:.3f}'.format(name, metric, reference, current))
+
+        if len(regressions) > 0:
+            exit(1)
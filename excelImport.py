@@ -1,6 +1,6 @@
 from config import get_config
 from fikTools.file import save_csv_file, save_text_file, join, is_older, get_files, load_json_file, save_json_file, load_text_file
-import fikTools.log
+import fikTools.log as log
 import os
 import time
 
@@ -10,7 +10,7 @@ def get_table_info(wb, tab_name):
 
     string = ws.cell(row=1, column=2).value
 
-    log.debug('Processing tab {}: {}'.format(tab_name, string), trace_level='ref data import', file=__file__)
+    log.debug('Processing tab {}: {}', args=(tab_name, string), trace_level='ref data import', file=__file__)
 
     top, bottom = string.split(':')
 
@@ -27,28 +27,29 @@ def process_excel(wb, table_info, csv_file):
 
     ws = wb[table_info['tab name']]
 
-    sheet_data = []
-
-    log.debug('Sheet: {}, rows {} to {}, columns {} to {}'.format(table_info['tab name'], table_info['first row'], table_info['last row'], table_info['first column'], table_info['last column']), trace_level='ref data import', file=__file__)
-
-    row_count = 0
-    for row in ws.values:
-        row_count += 1
-        if row_count >= table_info['first row']:
-            row_data = []
-            column_count = 0
-            for cell in row:
-                column_count += 1
-                if column_count >= table_info['first column']:
-                    row_data.append(cell)
-                if column_count > table_info['last column']:
+    log.debug('Sheet: {}, rows {} to {}, columns {} to {}', args=(table_info['tab name'], table_info['first row'], table_info['last row'], table_info['first column'], table_info['last column']), trace_level='ref data import', file=__file__)
+
+    # Rows are streamed to the CSV file as they are read, rather than collected first
+
+    def sheet_data():
+        row_count = 0
+        for row in ws.values:
+            row_count += 1
+            if row_count >= table_info['first row']:
+                row_data = []
+                column_count = 0
+                for cell in row:
+                    column_count += 1
+                    if column_count >= table_info['first column']:
+                        row_data.append(cell)
+                    if column_count > table_info['last column']:
+                        break
+
+                yield row_data
+                if row_count > table_info['last row']:
                     break
 
-            sheet_data.append(row_data)
-            if row_count > table_info['last row']:
-                break
-
-    save_csv_file(csv_file, sheet_data)
+    save_csv_file(csv_file, sheet_data())
 
 
 def save_data_types(code, data):
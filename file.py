@@ -1,14 +1,355 @@
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 import csv
+import hashlib
+import itertools
 import json
-from fikTools.log import get_log, get_warnings, fatal
+from fikTools.log import get_warnings, fatal, iter_log, message
+import mmap
 import os
-from os import listdir
 from os.path import isfile, isdir, join
-from shutil import copyfile
+import pickle
+from shutil import copyfile, copymode
 import re
+import threading
 import time
 from pathlib import Path
 
+# Optional JSON libraries, used instead of the standard library when selected with set_json_backend
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+_json_backend = 'json'
+
+# Optional binary copies of JSON files, loaded instead of parsing the JSON again while they are valid (see
+# enable_json_cache)
+
+_json_cache_settings = {
+    'enabled': False,
+    'directory': None,
+}
+
+# Offsets of the records of JSON Lines files, with the size and modification time they were built for (see
+# index_jsonl_file)
+
+_jsonl_indexes = {}
+
+# Files are saved to a temporary file, renamed over the target once complete, so that a crash or a parallel build never
+# leaves a truncated file behind. Flushing them to disk (fsync) is optional, per file or grouped by fsync_batch
+
+_write_settings = {
+    'fsync': False,
+    'batch': None,
+    'batch_depth': 0,
+}
+
+_write_lock = threading.Lock()
+
+_temporary_counter = itertools.count()
+
+# Optional cache of file modification times, used by time_of_last_update and the functions built on it
+# (is_older, is_more_recent) - disabled by default, see enable_stat_cache
+
+_stat_cache = {}
+
+_stat_cache_settings = {
+    'enabled': False,
+    'ttl': None,
+}
+
+
+def _invalidate_stat(filename):
+    _stat_cache.pop(filename, None)
+
+
+def _modification_time(filename):
+    # One stat call (instead of exists then stat), 0 if the file does not exist
+
+    if _stat_cache_settings['enabled']:
+        entry = _stat_cache.get(filename)
+
+        if entry is not None and (_stat_cache_settings['ttl'] is None or time.monotonic() - entry[1] < _stat_cache_settings['ttl']):
+            return entry[0]
+
+    try:
+        modification_time = os.stat(filename).st_mtime
+
+    except (OSError, ValueError):
+        modification_time = 0
+
+    if _stat_cache_settings['enabled']:
+        _stat_cache[filename] = (modification_time, time.monotonic())
+
+    return modification_time
+
+
+# Directory fingerprints (see directory_fingerprint): directory -> {'mtime', 'files': {name: [size, mtime, digest]},
+# 'directories': [names]}
+
+_directory_fingerprints = {}
+
+
+def _fingerprint_directory(directory, content_hash, trust_directory_mtime):
+    # Returns the most recent modification time in the subtree and, if content_hash is set, a digest of the subtree
+    # The directory is only listed again if its own modification time changed
+
+    try:
+        directory_mtime = os.stat(directory).st_mtime
+
+    except (OSError, ValueError):
+        _directory_fingerprints.pop(directory, None)
+        return 0, ''
+
+    entry = _directory_fingerprints.get(directory)
+    listed = False
+
+    if entry is None or entry['mtime'] != directory_mtime:
+        files, directories = _list_directory(directory)
+
+        previous_files = entry['files'] if entry is not None else {}
+
+        entry = {
+            'mtime': directory_mtime,
+            'files': {name: previous_files.get(name) for name in files},
+            'directories': directories,
+        }
+        _directory_fingerprints[directory] = entry
+        listed = True
+
+    newest = directory_mtime
+    digest = hashlib.sha256() if content_hash else None
+
+    for name in sorted(entry['files'].keys()):
+        info = entry['files'][name]
+
+        if info is None or listed or not trust_directory_mtime:
+            try:
+                stat = os.stat(join(directory, name))
+
+            except (OSError, ValueError):
+                continue
+
+            if info is None or info[0] != stat.st_size or info[1] != stat.st_mtime:
+                info = [stat.st_size, stat.st_mtime, None]
+
+        if content_hash and info[2] is None:
+            info[2] = file_digest(join(directory, name))
+
+        entry['files'][name] = info
+
+        if info[1] > newest:
+            newest = info[1]
+
+        if content_hash:
+            digest.update('{}\0{}\0'.format(name, info[2]).encode('utf-8'))
+
+    for name in sorted(entry['directories']):
+        subdirectory_newest, subdirectory_digest = _fingerprint_directory(join(directory, name), content_hash, trust_directory_mtime)
+
+        if subdirectory_newest > newest:
+            newest = subdirectory_newest
+
+        if content_hash:
+            digest.update('{}/\0{}\0'.format(name, subdirectory_digest).encode('utf-8'))
+
+    return newest, digest.hexdigest() if content_hash else ''
+
+
+# Content hash databases (see is_stale and record_build), kept in memory once loaded: database file -> data
+# Each database records, for every target in its directory, the digests of the inputs it was built from, as well as
+# a digest cache keyed on the size and modification time of each input, so that unchanged files are not hashed again
+
+_hash_database_name = '.content_hashes.json'
+
+_hash_databases = {}
+
+
+def _hash_database(target, database_file):
+    if database_file is None:
+        database_file = join(os.path.dirname(os.path.abspath(target)), _hash_database_name)
+
+    if database_file not in _hash_databases.keys():
+        _hash_databases[database_file] = _read_hash_database(database_file)
+
+    return database_file, _hash_databases[database_file]
+
+
+def _read_hash_database(database_file):
+    data = None
+
+    try:
+        with open(database_file, encoding='utf-8') as source:
+            data = json.load(source)
+
+    except (OSError, ValueError):
+        pass
+
+    if not isinstance(data, dict) or 'targets' not in data.keys() or 'digests' not in data.keys():
+        data = {'targets': {}, 'digests': {}}
+
+    return data
+
+
+def _save_hash_database(database_file, database, target_key):
+    # Several processes can record builds in the same database: under a lock file, the database is read again and this
+    # process' record of the target merged into it, so that the records of the other processes are kept
+
+    lock_file = '{}.lock'.format(database_file)
+
+    mkdir(os.path.dirname(database_file))
+
+    while True:
+        try:
+            os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+
+        except FileExistsError:
+            # Lock files left behind by crashed processes are ignored after a minute
+
+            try:
+                if time.time() - os.path.getmtime(lock_file) > 60:
+                    os.remove(lock_file)
+
+            except OSError:
+                pass
+
+            time.sleep(0.01)
+
+    try:
+        merged = _read_hash_database(database_file)
+
+        merged['digests'].update(database['digests'])
+        merged['targets'][target_key] = database['targets'][target_key]
+
+        # Saved at once even inside fsync_batch, as other processes read it again as soon as the lock is released
+
+        with _atomic_open(database_file, 'w', batched=False, encoding='utf-8') as target:
+            json.dump(merged, target, sort_keys=True, ensure_ascii=False, indent=4)
+
+        _invalidate_stat(database_file)
+
+    finally:
+        os.remove(lock_file)
+
+    database['targets'] = merged['targets']
+    database['digests'] = merged['digests']
+
+
+def _database_key(database_file, filename):
+    # Paths are stored relative to the database, so that the database stays valid when the tree is moved or checked
+    # out elsewhere
+
+    return os.path.relpath(os.path.abspath(filename), os.path.dirname(os.path.abspath(database_file)))
+
+
+def _cached_digest(database_file, database, filename):
+    try:
+        stat = os.stat(filename)
+
+    except (OSError, ValueError):
+        return ''
+
+    key = _database_key(database_file, filename)
+    entry = database['digests'].get(key)
+
+    if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+        return entry[2]
+
+    digest = file_digest(filename)
+
+    database['digests'][key] = [stat.st_size, stat.st_mtime, digest]
+
+    return digest
+
+
+def _fsync_directory(directory):
+    # Makes renames in the directory durable - not possible (nor needed) on Windows
+
+    try:
+        descriptor = os.open(directory or '.', os.O_RDONLY)
+
+    except OSError:
+        return
+
+    try:
+        os.fsync(descriptor)
+
+    except OSError:
+        pass
+
+    finally:
+        os.close(descriptor)
+
+
+def _fsync_file(filename):
+    descriptor = os.open(filename, os.O_RDONLY)
+
+    try:
+        os.fsync(descriptor)
+
+    finally:
+        os.close(descriptor)
+
+
+@contextmanager
+def _atomic_open(target_file, mode, batched=True, **kwargs):
+    # A symbolic link is written through, to the file it points to, rather than replaced by a regular file
+    # Inside fsync_batch (unless batched is False), the temporary file is only renamed over the target when the batch
+    # ends, once flushed to disk
+
+    target_file = os.path.realpath(target_file)
+    temporary_file = '{}.{}.{}.{}.tmp'.format(target_file, os.getpid(), threading.get_ident(), next(_temporary_counter))
+
+    batch = _write_settings['batch'] if batched else None
+
+    try:
+        with open(temporary_file, mode, **kwargs) as target:
+            yield target
+
+            if _write_settings['fsync'] and batch is None:
+                target.flush()
+                os.fsync(target.fileno())
+
+        if batch is not None:
+            with _write_lock:
+                replaced = batch.get(target_file)
+                batch[target_file] = temporary_file
+
+            if replaced is not None and os.path.exists(replaced):
+                os.remove(replaced)
+
+            return
+
+        _replace(temporary_file, target_file)
+
+    except BaseException:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+        raise
+
+    if _write_settings['fsync']:
+        _fsync_directory(os.path.dirname(target_file))
+
+
+def _replace(temporary_file, target_file):
+    if isfile(target_file):
+        copymode(target_file, temporary_file)
+
+    os.replace(temporary_file, target_file)
+
+    _invalidate_stat(target_file)
+
 
 def archive(source, destination, create_directory=False):
     if not exists(source):
@@ -29,49 +370,200 @@ def archive(source, destination, create_directory=False):
 
 
 def copy(source, destination):
-    return copyfile(source, destination)
+    result = copyfile(source, destination)
 
+    _invalidate_stat(destination)
 
-def copy_dir(source, destination, substitutions={}):
-    result = []
+    return result
 
-    log.message('copying {} to {}'.format(source, destination))
 
-    mkdir(destination)
+def _copy_dir_file(source_file, final_file, link, links, skip_unchanged):
+    # links tells whether linking is possible (same file system), and is turned off the first time a reflink fails
 
-    for source_file in get_files(source):
-        (root_dir, file) = os.path.split(source_file)
+    source_stat = os.stat(source_file)
 
-        # Manage the subdirectory
-        subdir = root_dir.split('/')[-1]
-        for entry in substitutions.keys():
-            subdir = subdir.replace(entry, substitutions[entry])
-        subdir = join(destination, subdir)
-        mkdir(subdir)
+    if skip_unchanged:
+        try:
+            final_stat = os.stat(final_file)
 
-        # Manage the file
+            if final_stat.st_size == source_stat.st_size and final_stat.st_mtime_ns == source_stat.st_mtime_ns:
+                return
 
+        except FileNotFoundError:
+            pass
+
+    # The copy (or link) is made to a new temporary file, renamed over the target: the target can be a hardlink to the
+    # source, left by a previous copy, which must not be written to, and a failed copy never leaves a truncated file
+
+    temporary_file = '{}.{}.{}.tmp'.format(final_file, os.getpid(), threading.get_ident())
+
+    try:
+        if link == 'hardlink' and links['enabled']:
+            os.link(source_file, temporary_file)
+
+        elif link == 'reflink' and links['enabled'] and _reflink(source_file, temporary_file):
+            pass
+
+        else:
+            if link == 'reflink':
+                links['enabled'] = False
+
+            copyfile(source_file, temporary_file)
+
+        if skip_unchanged and link != 'hardlink':
+            os.utime(temporary_file, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
+        os.replace(temporary_file, final_file)
+
+    except BaseException:
+        if os.path.lexists(temporary_file):
+            os.remove(temporary_file)
+
+        raise
+
+    _invalidate_stat(final_file)
+
+
+def _reflink(source_file, final_file):
+    # Copy-on-write clone of the file (Linux, on file systems such as Btrfs or XFS) to a new file - False when not
+    # supported
+
+    try:
+        import fcntl
+
+    except ImportError:
+        return False
+
+    ficlone = 0x40049409
+
+    with open(source_file, 'rb') as source, open(final_file, 'wb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), ficlone, source.fileno())
+            return True
+
+        except OSError:
+            return False
+
+
+def copy_dir(source, destination, substitutions={}, recursive=False, workers=None, link=None, skip_unchanged=False):
+    # Copies the files of source to destination/<name of source>, applying substitutions to the directory and file
+    # names, and returns the list of destination files
+    # - recursive: subdirectories are copied too, below the same relative paths
+    # - workers: number of threads copying files in parallel (one at a time by default)
+    # - link: 'hardlink' or 'reflink' (copy-on-write clone) instead of copying, when source and destination share a
+    #   file system - hardlinked files share their content with the source, so only for trees that are not edited
+    # - skip_unchanged: files whose size and modification time already match are not copied again (copies then keep the
+    #   modification time of their source)
+
+    result = []
+
+    message('copying {} to {}'.format(source, destination))
+
+    if link not in [None, 'hardlink', 'reflink']:
+        raise Exception('Unknown link mode [{}]'.format(link))
+
+    def substitute(name):
         for entry in substitutions.keys():
-            file = file.replace(entry, substitutions[entry])
-        final_file = join(subdir, file)
+            name = name.replace(entry, substitutions[entry])
+        return name
+
+    # Plan the copy first, so that each destination directory is created once
+
+    root = join(destination, substitute(os.path.basename(os.path.normpath(source))))
+
+    if recursive:
+        source_files = iter_files_recursively(source)
+    else:
+        source_files = get_files(source)
+
+    copies = []
+    directories = {root}
 
-        # Copy
+    for source_file in source_files:
+        relative_directory, file = os.path.split(os.path.relpath(source_file, source))
 
-        copy(source_file, final_file)
+        subdir = root
+        for part in relative_directory.split(os.sep) if relative_directory != '' else []:
+            subdir = join(subdir, substitute(part))
+        directories.add(subdir)
 
+        final_file = join(subdir, substitute(file))
+
+        copies.append((source_file, final_file))
         result.append(final_file)
 
+    mkdir(destination)
+
+    for directory in sorted(directories):
+        mkdir(directory)
+
+    links = {'enabled': link is not None and os.stat(source).st_dev == os.stat(root).st_dev}
+
+    def copy_file(entry):
+        _copy_dir_file(entry[0], entry[1], link, links, skip_unchanged)
+
+    if workers is None or workers <= 1:
+        for entry in copies:
+            copy_file(entry)
+
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(copy_file, copies))
+
     return result
 
 
 def delete(file):
     os.remove(file)
 
+    _invalidate_stat(file)
+
+
+def directory_fingerprint(directory, content_hash=False, trust_directory_mtime=False):
+    # Fingerprint of a directory and everything below it: {'time': most recent modification time, 'digest': SHA-256
+    # over the names and contents of all files ('' unless content_hash is set)}
+    # Results are cached per directory: a directory is only listed again when its own modification time changes, and
+    # files are only hashed again when their size or modification time changes
+    # With trust_directory_mtime set, the files of unchanged directories are not even checked - much cheaper, but files
+    # modified in place (which does not update the directory's modification time) are then missed
+
+    newest, digest = _fingerprint_directory(directory, content_hash, trust_directory_mtime)
+
+    return {
+        'time': newest,
+        'digest': digest,
+    }
+
+
+def disable_stat_cache():
+    _stat_cache_settings['enabled'] = False
+
+    _stat_cache.clear()
+
+
+def enable_stat_cache(ttl=None):
+    # Modification times are then only read once per file, until they are invalidated (invalidate_stat_cache), or
+    # until they are older than ttl seconds if a ttl is provided
+    # Files written through this module (save_*, copy, delete, rename, touch) are invalidated automatically
+
+    _stat_cache_settings['enabled'] = True
+    _stat_cache_settings['ttl'] = ttl
+
 
 def exists(filename):
     return os.path.exists(filename)
 
 
+def disable_fsync():
+    _write_settings['fsync'] = False
+
+
+def enable_fsync():
+    # Saved files are flushed to disk, with the rename that completes them, before the save functions return
+
+    _write_settings['fsync'] = True
+
+
 def extract_directory_name(path):
     directory, ignore = os.path.split(path)
 
@@ -84,12 +576,85 @@ def extract_file_name(path, without_extension=False):
     return file if without_extension is False else re.sub(r'\.[^.]+$', '', file)
 
 
+def _list_directory(directory):
+    # Lists a directory once, returning the names of its files and of its subdirectories in directory order
+    # (scandir gets the entry types along with the names, so there is no stat call per entry)
+
+    files = []
+    directories = []
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                files.append(entry.name)
+            elif entry.is_dir():
+                directories.append(entry.name)
+
+    return files, directories
+
+
+def file_digest(filename):
+    # SHA-256 of the file's content, '' if the file does not exist
+
+    digest = hashlib.sha256()
+
+    try:
+        with open(filename, 'rb') as source:
+            for block in iter(lambda: source.read(1 << 20), b''):
+                digest.update(block)
+
+    except FileNotFoundError:
+        return ''
+
+    return digest.hexdigest()
+
+
+@contextmanager
+def fsync_batch(workers=8):
+    # Files saved inside the block (from any thread) are written to temporary files, and only replace their targets
+    # when the block ends: the temporary files are flushed to disk in parallel, then renamed, then each directory is
+    # flushed once - instead of two fsync calls per file. A crash inside the block leaves the previous versions of the
+    # files, and saved files cannot be read back before the block ends
+
+    with _write_lock:
+        if _write_settings['batch_depth'] == 0:
+            _write_settings['batch'] = {}
+
+        _write_settings['batch_depth'] += 1
+
+    try:
+        yield
+
+    finally:
+        with _write_lock:
+            _write_settings['batch_depth'] -= 1
+
+            if _write_settings['batch_depth'] == 0:
+                files = _write_settings['batch']
+                _write_settings['batch'] = None
+
+            else:
+                files = None
+
+        if files:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(_fsync_file, files.values()))
+
+            for target_file, temporary_file in files.items():
+                _replace(temporary_file, target_file)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(_fsync_directory, list(dict.fromkeys(os.path.dirname(f) for f in files.keys()))))
+
+
 def get_directories(directory, regexp='.*'):
     result = []
 
     pattern = re.compile(regexp)
 
-    for file in [f for f in listdir(directory) if isdir(join(directory, f))]:
+    ignore, directories = _list_directory(directory)
+
+    for file in directories:
 
         match = pattern.match(file)
 
@@ -106,7 +671,9 @@ def get_files(directory, regexp='.*'):
     pattern = re.compile(regexp)
 
     try:
-        for file in [f for f in listdir(directory) if isfile(join(directory, f))]:
+        files, ignore = _list_directory(directory)
+
+        for file in files:
 
             match = pattern.match(file)
 
@@ -126,12 +693,15 @@ def get_files_and_directories(directory, regexp='.*', remove_directory=False):
 
     mkdir(directory)
 
-    for file in [f for f in listdir(directory) if (isfile(join(directory, f)) or isdir(join(directory, f)))]:
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not (entry.is_file() or entry.is_dir()):
+                continue
 
-        match = pattern.match(file)
+            match = pattern.match(entry.name)
 
-        if match is not None:
-            result.append(file)
+            if match is not None:
+                result.append(entry.name)
 
     return result if remove_directory else list(map(lambda f: join(directory, f), result))
 
@@ -142,8 +712,10 @@ def get_files_recursively(directory, regexp='.*', file_names_only=False):
 
     pattern = re.compile(regexp)
 
+    files, directories = _list_directory(directory)
+
     # Add the files that match the pattern
-    for file in [f for f in listdir(directory) if isfile(join(directory, f))]:
+    for file in files:
 
         match = pattern.match(file)
 
@@ -151,7 +723,7 @@ def get_files_recursively(directory, regexp='.*', file_names_only=False):
             result.append(file)
 
     # Parse the directories
-    for dir in [f for f in listdir(directory) if isdir(join(directory, f))]:
+    for dir in directories:
         if file_names_only:
             result += get_files_recursively(join(directory, dir), regexp=regexp, file_names_only=file_names_only)
         else:
@@ -160,7 +732,89 @@ def get_files_recursively(directory, regexp='.*', file_names_only=False):
     return result
 
 
-def get_numbered_file_name(directory, file, create_directories=False):
+def iter_files_recursively(directory, regexp='.*', file_names_only=False, max_depth=None, prune=None):
+    # Yields the files matching a pattern, across the directory and its subdirectories, as they are found
+    # (same order as get_files_recursively, but the paths always start with directory unless file_names_only is set)
+    # - regexp can be a string or an already compiled pattern
+    # - max_depth limits how many levels of subdirectories are walked (0: the directory only)
+    # - prune is called with the path of every subdirectory found, and the subdirectory is skipped if it returns True
+
+    pattern = regexp if isinstance(regexp, re.Pattern) else re.compile(regexp)
+
+    stack = [(directory, 0)]
+
+    while len(stack) > 0:
+        current, depth = stack.pop()
+
+        files, directories = _list_directory(current)
+
+        for file in files:
+            if pattern.match(file) is not None:
+                yield file if file_names_only else join(current, file)
+
+        if max_depth is not None and depth >= max_depth:
+            continue
+
+        # Pushed in reverse, so that the subdirectories are walked in directory order
+
+        for dir in reversed(directories):
+            path = join(current, dir)
+
+            if prune is None or not prune(path):
+                stack.append((path, depth + 1))
+
+
+def get_files_recursively_parallel(directory, regexp='.*', file_names_only=False, workers=8, ordered=False):
+    # Same as iter_files_recursively, but the directories are read by a pool of threads, so that slow (e.g. network)
+    # file systems are read in parallel - returns a list
+    # With ordered set, the result is in the same order as iter_files_recursively, otherwise in the order directories
+    # are read
+
+    pattern = regexp if isinstance(regexp, re.Pattern) else re.compile(regexp)
+
+    result = []
+    listings = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_list_directory, directory): directory}
+
+        while len(pending) > 0:
+            done, ignore = wait(pending.keys(), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                current = pending.pop(future)
+
+                files, directories = future.result()
+
+                files = [file if file_names_only else join(current, file) for file in files if pattern.match(file) is not None]
+                directories = [join(current, dir) for dir in directories]
+
+                if ordered:
+                    listings[current] = (files, directories)
+                else:
+                    result += files
+
+                for path in directories:
+                    pending[executor.submit(_list_directory, path)] = path
+
+    if ordered:
+        stack = [directory]
+
+        while len(stack) > 0:
+            files, directories = listings[stack.pop()]
+
+            result += files
+            stack += reversed(directories)
+
+    return result
+
+
+def get_numbered_file_name(directory, file, create_directories=False, reserve=False):
+    # Next free name of the form <name>_<counter>.<extension> in directory. The last counter is kept in an index file
+    # (.<file>.counter), so that the cost does not depend on the number of files in the directory
+    # - reserve: the file is created (empty) to reserve the name, so that concurrent processes never get the same one,
+    #   and the index is updated - otherwise nothing is written, and the name may be taken by another process before it
+    #   is used
 
     if create_directories:
         mkdir(directory)
@@ -168,24 +822,74 @@ def get_numbered_file_name(directory, file, create_directories=False):
     filename, file_extension = os.path.splitext(file)
     file_extension = file_extension[1:]
 
-    regexp_1 = '^' + filename + '_(.*)\\.' + file_extension
-    regexp_2 = '^' + join(directory, filename) + '_(.*)\\.' + file_extension
-    pattern = re.compile(regexp_2)
+    index_file = join(directory, '.{}.counter'.format(file))
 
-    counter = 0
+    try:
+        with open(index_file) as index:
+            counter = int(index.read())
+
+    except (FileNotFoundError, NotADirectoryError, ValueError):
+        counter = _last_numbered_file(directory, filename, file_extension)
+
+    while True:
+        counter += 1
+        numbered_file = join(directory, filename + '_' + str(counter) + '.' + file_extension)
+
+        if not reserve:
+            if not os.path.lexists(numbered_file):
+                return numbered_file
+
+            continue
+
+        try:
+            os.close(os.open(numbered_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+
+        except FileExistsError:
+            continue
+
+    # The index is only a hint: another process may overwrite it with a lower counter, which costs a few retries
+
+    try:
+        with _atomic_open(index_file, 'w') as index:
+            index.write(str(counter))
+
+    except OSError:
+        pass
 
-    for f in get_files(directory, regexp=regexp_1):
-        # log.debug('[' + f + '] vs [' + regexp_2 + ']', no_trace=True, file=__file__)
-        match = pattern.match(f)  # match cannot be empty
+    _invalidate_stat(numbered_file)
 
-        c = int(match[1])
+    return numbered_file
+
+
+def _last_numbered_file(directory, filename, file_extension):
+    # Highest counter among the existing files, for directories without an index file yet
+
+    pattern = re.compile('^' + re.escape(filename) + '_([0-9]+)\\.' + re.escape(file_extension) + '$')
+
+    counter = 0
+
+    for f in get_files(directory, regexp=pattern.pattern):
+        c = int(pattern.match(os.path.basename(f))[1])
 
         if counter < c:
             counter = c
 
-    counter += 1
+    return counter
+
 
-    return join(directory, filename + '_' + str(counter) + '.' + file_extension)
+def invalidate_stat_cache(files=None):
+    # Forgets the cached modification times of the files provided (a file name or a list of them), or of all files
+
+    if files is None:
+        _stat_cache.clear()
+        return
+
+    if isinstance(files, str):
+        files = [files]
+
+    for file in files:
+        _invalidate_stat(file)
 
 
 def is_directory(file):
@@ -196,10 +900,35 @@ def is_file(file):
     return isfile(file)
 
 
+def _compare_with_any(file, file_set, older):
+    # One pass over the file set: the file is looked up once, and the file set only until the first match - with the
+    # stat cache (see enable_stat_cache), files shared by many targets are only looked up once
+
+    file_timestamp = _modification_time(file)
+
+    if isinstance(file_set, str):
+        file_set = [file_set]
+
+    if older:
+        return any(file_timestamp < _modification_time(f) for f in file_set)
+
+    return any(file_timestamp > _modification_time(f) for f in file_set)
+
+
+def is_older_than_any(file, dependencies):
+    # True if any of the dependencies was updated after the file (or if the file does not exist and any dependency
+    # does) - the check to rebuild a target from thousands of dependencies
+
+    return _compare_with_any(file, dependencies, older=True)
+
+
 def is_older(file, file_set, is_older_than_all=False, trace=False, verbose=False):
 
     # Will return true if the file is older than *any* file in the file set to compare with
 
+    if not (is_older_than_all or trace or verbose):
+        return is_older_than_any(file, file_set)
+
     file_timestamp = time_of_last_update(file)
 
     if trace is True:
@@ -245,6 +974,9 @@ def is_older(file, file_set, is_older_than_all=False, trace=False, verbose=False
 def is_more_recent(file, file_set, is_more_recent_than_all=False, trace=False):
     # Will return true if the file is older than *any* file in the file set to compare with
 
+    if not (is_more_recent_than_all or trace):
+        return _compare_with_any(file, file_set, older=False)
+
     file_timestamp = time_of_last_update(file)
 
     if trace is True:
@@ -284,6 +1016,33 @@ def is_more_recent(file, file_set, is_more_recent_than_all=False, trace=False):
     return False
 
 
+def is_stale(file, file_set, database_file=None):
+    # Content based alternative to is_older: returns True if the file does not exist, was never recorded with
+    # record_build, or if the content of its inputs (or the list of inputs) changed since it was recorded
+    # Modification times are only used to avoid hashing files again, so fresh checkouts do not trigger rebuilds
+
+    if isinstance(file_set, str):
+        file_set = [file_set]
+
+    if not exists(file):
+        return True
+
+    database_file, database = _hash_database(file, database_file)
+
+    recorded = database['targets'].get(_database_key(database_file, file))
+
+    if recorded is None or set(recorded.keys()) != {_database_key(database_file, f) for f in file_set}:
+        return True
+
+    for f in file_set:
+        key = _database_key(database_file, f)
+
+        if key not in recorded.keys() or recorded[key] != _cached_digest(database_file, database, f):
+            return True
+
+    return False
+
+
 def join(directory, filename=''):
     if isinstance(directory, str):
         return os.path.join(directory, filename)
@@ -294,24 +1053,298 @@ def join(directory, filename=''):
     return result
 
 
-def load_csv_file(source_file):
-    data = []
+def iter_csv_file(source_file, types=None, chunk_size=None):
+    # Rows of a CSV file, read one at a time. types converts columns, as a list with one function (or None, to keep the
+    # string) per column or a dictionary column number -> function - empty cells of converted columns become None.
+    # With chunk_size, rows come in lists of up to chunk_size rows
+
+    rows = _read_csv_rows(source_file, types)
+
+    if chunk_size is None:
+        yield from rows
+        return
+
+    chunk = []
+
+    for row in rows:
+        chunk.append(row)
+
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def _read_csv_rows(source_file, types):
+    if isinstance(types, (list, tuple)):
+        types = {column: function for column, function in enumerate(types) if function is not None}
 
     with open(source_file, newline='') as csv_file:
         csv_data = csv.reader(csv_file, delimiter=',', quotechar='"')
 
+        if not types:
+            yield from csv_data
+            return
+
         for row in csv_data:
-            data.append(row)
+            for column, function in types.items():
+                if column < len(row):
+                    row[column] = function(row[column]) if row[column] != '' else None
+
+            yield row
+
+
+def load_csv_file(source_file, types=None):
+    return list(_read_csv_rows(source_file, types))
+
+
+def _json_cache_file(source_file):
+    if _json_cache_settings['directory'] is None:
+        return '{}.cache.pickle'.format(source_file)
+
+    return join(_json_cache_settings['directory'], '{}.pickle'.format(hashlib.sha1(os.path.abspath(source_file).encode('utf-8')).hexdigest()))
+
+
+def _load_json_cache(source_file, stat):
+    try:
+        with open(_json_cache_file(source_file), 'rb') as source:
+            cached = pickle.load(source)
+
+    except Exception:  # Missing, truncated or otherwise unreadable cache files are simply rebuilt
+        return None
+
+    if not isinstance(cached, dict) or cached.get('size') != stat.st_size or cached.get('mtime') != stat.st_mtime:
+        return None
+
+    return cached
+
+
+def _save_json_cache(source_file, stat, data):
+    try:
+        if _json_cache_settings['directory'] is not None:
+            mkdir(_json_cache_settings['directory'])
+
+        with _atomic_open(_json_cache_file(source_file), 'wb') as target:
+            pickle.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'data': data}, target, protocol=pickle.HIGHEST_PROTOCOL)
+
+    except OSError:
+        pass
+
+
+def disable_json_cache():
+    _json_cache_settings['enabled'] = False
 
-    return data
+
+def enable_json_cache(directory=None):
+    # load_json_file then keeps a pickled copy of each file it parses, valid as long as the JSON file keeps the same
+    # size and modification time - next to the JSON file (file.json.cache.pickle), or in directory if provided
+
+    _json_cache_settings['enabled'] = True
+    _json_cache_settings['directory'] = directory
+
+
+def get_json_backend():
+    return _json_backend
 
 
 def load_json_file(source_file):
-    with open(source_file) as source_data:
-        try:
-            return json.load(source_data)
-        except json.decoder.JSONDecodeError:
-            fatal('could not parse JSON file {}'.format(source_file))
+    if _json_cache_settings['enabled']:
+        stat = os.stat(source_file)
+
+        cached = _load_json_cache(source_file, stat)
+
+        if cached is not None:
+            return cached['data']
+
+        data = _parse_json_file(source_file)
+
+        _save_json_cache(source_file, stat, data)
+
+        return data
+
+    return _parse_json_file(source_file)
+
+
+def _json_dumps(data, backend):
+    # Compact encoding, as bytes
+
+    if backend == 'orjson':
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    elif backend == 'ujson':
+        return ujson.dumps(data, ensure_ascii=False).encode('utf-8')
+    else:
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _json_loads(content, backend):
+    # Content the faster backends reject (such as NaN and Infinity) is parsed again by the standard library, which
+    # accepts whatever save_json_file writes
+
+    try:
+        if backend == 'orjson':
+            return orjson.loads(content)
+        elif backend == 'ujson':
+            return ujson.loads(content)
+
+    except ValueError:
+        pass
+
+    return json.loads(content)
+
+
+def _parse_json_file(source_file):
+    with open(source_file, 'rb') as source_data:
+        content = source_data.read()
+
+    try:
+        return _json_loads(content, _json_backend)
+
+    except ValueError:  # Parsing errors of all the backends derive from ValueError
+        fatal('could not parse JSON file {}'.format(source_file))
+
+
+# JSON Lines files: one compact JSON document per line, written and read one record at a time. Readers map the file in
+# memory and index the offsets of its records, for random access and parallel parsing of large files
+
+def index_jsonl_file(source_file):
+    # Offsets of the records (non-empty lines) of a JSON Lines file, kept until the file changes
+
+    stat = os.stat(source_file)
+    key = os.path.abspath(source_file)
+
+    if key in _jsonl_indexes and _jsonl_indexes[key][0] == (stat.st_size, stat.st_mtime):
+        return _jsonl_indexes[key][1]
+
+    offsets = array('Q')
+
+    if stat.st_size > 0:
+        with open(source_file, 'rb') as source, mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            start = 0
+
+            while start < stat.st_size:
+                end = content.find(b'\n', start)
+
+                if end == -1:
+                    end = stat.st_size
+
+                if content[start:end].strip():
+                    offsets.append(start)
+
+                start = end + 1
+
+    _jsonl_indexes[key] = ((stat.st_size, stat.st_mtime), offsets)
+
+    return offsets
+
+
+def count_jsonl_records(source_file):
+    return len(index_jsonl_file(source_file))
+
+
+def _load_jsonl_records(source_file, start, end, backend, function):
+    # Records between two byte offsets - module level, so that it can run in worker processes
+
+    with open(source_file, 'rb') as source, mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        records = [_json_loads(line, backend) for line in content[start:end].split(b'\n') if line.strip()]
+
+    if function is not None:
+        return [function(record) for record in records]
+
+    return records
+
+
+def iter_jsonl_file(source_file):
+    with open(source_file, 'rb') as source:
+        for line_number, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+
+            try:
+                yield _json_loads(line, _json_backend)
+
+            except ValueError:
+                fatal('could not parse line {} of JSON Lines file {}'.format(line_number, source_file))
+
+
+def iter_jsonl_file_parallel(source_file, function=None, processes=None, chunk_size=10000):
+    # Records in file order, parsed in chunks of chunk_size records by a pool of processes. Sending records back from
+    # the workers costs about as much as parsing them, so this pays off when function (a module level function, applied
+    # to each record in the workers) does the actual work and returns less than it receives
+
+    offsets = index_jsonl_file(source_file)
+    size = os.path.getsize(source_file)
+
+    if not offsets:
+        return
+
+    chunks = [(offsets[i], offsets[i + chunk_size] if i + chunk_size < len(offsets) else size) for i in range(0, len(offsets), chunk_size)]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # Only a couple of chunks per worker are in flight at once, so that memory stays bounded for large files
+
+        in_flight = 2 * processes
+        futures = []
+
+        for start, end in chunks:
+            futures.append(executor.submit(_load_jsonl_records, source_file, start, end, _json_backend, function))
+
+            if len(futures) >= in_flight:
+                yield from _jsonl_chunk_result(source_file, futures.pop(0))
+
+        for future in futures:
+            yield from _jsonl_chunk_result(source_file, future)
+
+
+def _jsonl_chunk_result(source_file, future):
+    try:
+        return future.result()
+
+    except ValueError:
+        fatal('could not parse JSON Lines file {}'.format(source_file))
+
+
+def load_jsonl_record(source_file, number):
+    # Record number (from 0) of a JSON Lines file, without reading the records before it
+
+    offsets = index_jsonl_file(source_file)
+
+    if number < 0 or number >= len(offsets):
+        raise Exception('JSON Lines file {} has no record {}'.format(source_file, number))
+
+    with open(source_file, 'rb') as source, mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        end = content.find(b'\n', offsets[number])
+        line = content[offsets[number]:end if end != -1 else len(content)]
+
+    try:
+        return _json_loads(line, _json_backend)
+
+    except ValueError:
+        fatal('could not parse record {} of JSON Lines file {}'.format(number, source_file))
+
+
+def save_jsonl_file(target_file, records, create_directories=False, append=False):
+    # Writes records one at a time, so that records can be any iterable, including a generator - returns their number.
+    # Appending writes to the file in place
+
+    if create_directories:
+        mkdir(os.path.dirname(target_file))
+
+    count = 0
+
+    with (open(target_file, 'ab') if append else _atomic_open(target_file, 'wb')) as target:
+        for record in records:
+            target.write(_json_dumps(record, _json_backend))
+            target.write(b'\n')
+            count += 1
+
+    _invalidate_stat(target_file)
+
+    return count
 
 
 def load_text_file(source_file):
@@ -336,6 +1369,21 @@ def move(source, destination):
     rename(source, destination)
 
 
+def record_build(file, file_set, database_file=None):
+    # Records the digests of the inputs a file was just built from, for is_stale
+
+    if isinstance(file_set, str):
+        file_set = [file_set]
+
+    database_file, database = _hash_database(file, database_file)
+
+    target_key = _database_key(database_file, file)
+
+    database['targets'][target_key] = {_database_key(database_file, f): _cached_digest(database_file, database, f) for f in file_set}
+
+    _save_hash_database(database_file, database, target_key)
+
+
 def remove_dir_and_contents(directory):
     # Will not recursively remove directories, only files
     for file in get_files(directory):
@@ -347,6 +1395,9 @@ def remove_dir_and_contents(directory):
 def rename(source, destination):
     os.rename(source, destination)
 
+    _invalidate_stat(source)
+    _invalidate_stat(destination)
+
 
 def rmdir(directory):
     os.rmdir(directory)
@@ -358,40 +1409,81 @@ def touch(file, create=False):
 
     Path(file).touch()
 
+    _invalidate_stat(file)
 
-def save_csv_file(target_file, data, create_directories=False):
+
+def save_csv_file(target_file, data, create_directories=False, append=False):
+    # data can be any iterable of rows, including a generator, so that large tables are written without being held in
+    # memory - returns the number of rows written. Appending writes to the file in place
 
     if create_directories:
         mkdir(os.path.dirname(target_file))
 
-    with open(target_file, mode='w') as file:
+    count = 0
+
+    with (open(target_file, mode='a') if append else _atomic_open(target_file, 'w')) as file:
         writer = csv.writer(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
         for element in data:
             writer.writerow(element)
+            count += 1
+
+    _invalidate_stat(target_file)
 
+    return count
 
-def save_json_file(target_file, data, create_directories=False):
+
+def save_json_file(target_file, data, create_directories=False, compact=False):
+    # The default (pretty) format is always written by the standard library, so that files kept under version control
+    # do not change with the backend - compact is meant for files only read by programs
 
     if create_directories:
         mkdir(os.path.dirname(target_file))
 
-    with open(target_file, 'w', encoding='utf-8') as target:
-        json.dump(data, target, sort_keys=True, ensure_ascii=False, indent=4)
+    if not compact:
+        with _atomic_open(target_file, 'w', encoding='utf-8') as target:
+            json.dump(data, target, sort_keys=True, ensure_ascii=False, indent=4)
+
+    else:
+        content = _json_dumps(data, _json_backend)
+
+        with _atomic_open(target_file, 'wb') as target:
+            target.write(content)
+
+    _invalidate_stat(target_file)
+
+
+def set_json_backend(backend):
+    # 'orjson', 'ujson' or 'json' (standard library, the default). The faster backends are not fully equivalent:
+    # - orjson reads integers beyond 64 bits as floats, losing precision (2**70 comes back as 1.1805916207174113e+21),
+    #   and cannot write them in compact files. It rejects NaN and Infinity when reading (the file is then read again
+    #   by the standard library), and writes them as null in compact files
+    # - ujson may also read integers beyond 64 bits and very precise floats with less precision, depending on its
+    #   version
+
+    global _json_backend
+
+    if backend not in ['orjson', 'ujson', 'json']:
+        raise Exception('Unknown JSON backend [{}]'.format(backend))
+
+    if backend != 'json' and {'orjson': orjson, 'ujson': ujson}[backend] is None:
+        raise Exception('JSON backend [{}] is not installed'.format(backend))
+
+    _json_backend = backend
 
 
 def save_log(directory='.', add_timestamps=False):
     text = []
 
-    log_data = get_log()
+    # The whole log, including the messages spilled to disk
 
-    for ts in sorted(log_data.keys()):
+    for sequence, timestamp, log_message in iter_log():
         text.append('{}{}'.format(
-            '{}: '.format(time.strftime('%Y-%0m-%0d %0H:%0M:%0S')) if add_timestamps else '',
-            log_data[ts]
+            '{}: '.format(time.strftime('%Y-%0m-%0d %0H:%0M:%0S', time.localtime(timestamp))) if add_timestamps else '',
+            log_message
         ))
 
-    file = get_numbered_file_name(directory=directory, file='log.txt', create_directories=True)
+    file = get_numbered_file_name(directory=directory, file='log.txt', create_directories=True, reserve=True)
     save_text_file(file, '\n'.join(text))
 
 
@@ -400,9 +1492,11 @@ def save_text_file(target_file, data, create_directories=False):
     if create_directories:
         mkdir(os.path.dirname(target_file))
 
-    with open(target_file, 'w', encoding='utf-8') as target:
+    with _atomic_open(target_file, 'w', encoding='utf-8') as target:
         target.write(data)
 
+    _invalidate_stat(target_file)
+
 
 def save_warnings(directory='.'):
     warnings_file = join(directory, 'warnings.csv')
@@ -434,20 +1528,15 @@ def save_warnings(directory='.'):
 
 
 def time_of_last_update(filename, check_directory_content=False):
-    if check_directory_content:
-        ts = time_of_last_update(filename, check_directory_content=False)
-        if is_directory(filename):
-            for file in (get_files(filename)):
-                ts_2 = time_of_last_update(file, check_directory_content=check_directory_content)
-                if ts_2 > ts:
-                    ts = ts_2
+    # With check_directory_content, the most recent update of the directory and of anything below it
 
-        return ts
+    if check_directory_content and is_directory(filename):
+        return directory_fingerprint(filename)['time']
 
-    if os.path.exists(filename):
+    return _modification_time(filename)
 
-        file = os.stat(filename)
 
-        return file.st_mtime
+def times_of_last_update(files):
+    # Modification times of many files at once (0 for missing files), as a dictionary file -> time
 
-    return 0
+    return {file: _modification_time(file) for file in files}
@@ -1,54 +1,231 @@
+import atexit
+from collections import deque
+from itertools import count, islice
+import json
+from json.encoder import encode_basestring
 import os
 import sys
+import tempfile
+import threading
 import time
 import traceback
 
 
-_log = {}
+# Log messages, as (sequence number, time, message), in a ring buffer keeping the most recent ones in memory. Messages
+# are spilled to a file (one line per message: sequence number, time and message as a JSON string) before they can
+# leave the buffer, so that none is ever lost: the file set with set_log_file, written every spill_every messages, or
+# else a temporary file, only written when the buffer is full and removed at exit. iter_log reads back the whole log,
+# spilled and buffered
+# - pending: number of messages at the end of the buffer not spilled yet
+# - segments: [file, start offset, end offset (None while still written to)] of the parts of the log spilled to files
+
+_log = deque(maxlen=100000)
+_log_sequence = count(1)
+_log_settings = {
+    'file': None,
+    'spill_every': 1000,
+    'pending': 0,
+    'temporary_file': None,
+    'segments': [],
+}
+_log_lock = threading.Lock()
 _stop_watch = {}
-_trace_levels = []
+_trace_levels = set()
 _warnings = {}
 
+# Caller descriptions built by f_name, per (code object, calling code object, file)
 
-def _message(msg, no_trace=False, trace_level=None, file='', send_to_screen=True):
-    global _trace_levels
+_caller_names = {}
+
+
+def _format(msg, args):
+    # Messages can be deferred: a callable returning the message, or a format string with its args, only formatted
+    # when the message is actually logged
+
+    if callable(msg):
+        return msg()
+
+    if args:
+        return msg.format(*args)
 
+    return msg
+
+
+def _message(msg, no_trace=False, trace_level=None, file='', send_to_screen=True, prefix='', args=()):
     if trace_level is not None and trace_level not in _trace_levels:
         return
 
-    log_message = '{}{}'.format('' if no_trace else '{}: '.format(f_name(file)), msg)
-    _log[time.time()] = log_message
+    log_message = '{}{}{}'.format('' if no_trace else '{}: '.format(f_name(file)), prefix, _format(msg, args))
+    _store(log_message)
 
     if send_to_screen:
         print(log_message)
 
 
+def _store(log_message):
+    with _log_lock:
+        _log.append((next(_log_sequence), time.time(), log_message))
+        _log_settings['pending'] += 1
+
+        if _log_settings['file'] is not None:
+            threshold = min(_log_settings['spill_every'], _log.maxlen)
+        else:
+            threshold = _log.maxlen
+
+        if _log_settings['pending'] >= threshold:
+            _spill()
+
+
+def _spill():
+    # Appends the messages not spilled yet to the log file - called with _log_lock held
+
+    if _log_settings['pending'] == 0:
+        return
+
+    if _log_settings['file'] is not None:
+        filename = _log_settings['file']
+
+    else:
+        if _log_settings['temporary_file'] is None:
+            descriptor, _log_settings['temporary_file'] = tempfile.mkstemp(prefix='log_', suffix='.jsonl')
+            os.close(descriptor)
+
+        filename = _log_settings['temporary_file']
+
+    segments = _log_settings['segments']
+
+    if len(segments) == 0 or segments[-1][0] != filename or segments[-1][2] is not None:
+        segments.append([filename, os.path.getsize(filename) if os.path.exists(filename) else 0, None])
+
+    entries = list(islice(reversed(_log), _log_settings['pending']))[::-1]
+
+    # Written in chunks, so that spilling a full buffer does not build one large string
+
+    with open(filename, 'a', encoding='utf-8') as target:
+        for i in range(0, len(entries), 10000):
+            target.write(''.join('{} {!r} {}\n'.format(sequence, timestamp, encode_basestring(log_message)) for sequence, timestamp, log_message in entries[i:i + 10000]))
+
+    _log_settings['pending'] = 0
+
+
+def _close_segment():
+    # Called with _log_lock held, before spilling to another file
+
+    segments = _log_settings['segments']
+
+    if len(segments) > 0 and segments[-1][2] is None:
+        segments[-1][2] = os.path.getsize(segments[-1][0])
+
+
+def _remove_temporary_file():
+    if _log_settings['temporary_file'] is not None and os.path.exists(_log_settings['temporary_file']):
+        os.remove(_log_settings['temporary_file'])
+
+
+def flush_log():
+    with _log_lock:
+        if _log_settings['file'] is not None:
+            _spill()
+
+
+atexit.register(_remove_temporary_file)
+atexit.register(flush_log)
+
+
+def iter_log():
+    # The whole log, as (sequence number, time, message), oldest first: what was spilled to files, then the messages
+    # only in memory
+
+    with _log_lock:
+        segments = [(filename, start, end if end is not None else os.path.getsize(filename)) for filename, start, end in _log_settings['segments']]
+        pending = list(islice(reversed(_log), _log_settings['pending']))[::-1]
+
+    for filename, start, end in segments:
+        with open(filename, 'rb') as source:
+            source.seek(start)
+
+            for line in source.read(end - start).decode('utf-8').splitlines():
+                sequence, timestamp, log_message = line.split(' ', 2)
+
+                yield int(sequence), float(timestamp), json.loads(log_message)
+
+    yield from pending
+
+
 def f_name(file=''):
-    return '{}{}() called from {}()'.format(
-        '{}.'.format(os.path.basename(file).replace('.py', '')) if file != '' else '',
-        # sys._getframe(3).f_code.co_name,
-        # sys._getframe(4).f_code.co_name
-        sys._getframe(2).f_code.co_name,
-        sys._getframe(3).f_code.co_name
-    )
+    frame = sys._getframe(2)
+    caller = frame.f_back
+
+    key = (frame.f_code, caller.f_code if caller is not None else None, file)
+
+    name = _caller_names.get(key)
+
+    if name is None:
+        name = '{}{}() called from {}()'.format(
+            '{}.'.format(os.path.basename(file).replace('.py', '')) if file != '' else '',
+            frame.f_code.co_name,
+            caller.f_code.co_name if caller is not None else ''
+        )
+
+        _caller_names[key] = name
+
+    return name
 
 
 def get_log():
-    return _log
+    # Messages still in the ring buffer, as a dictionary sequence number -> message (see iter_log for the whole log)
+
+    with _log_lock:
+        return {sequence: log_message for sequence, timestamp, log_message in _log}
 
 
 def get_warnings(section=''):
     return _warnings[section] if section != '' else _warnings.keys()
 
 
+def set_log_capacity(capacity):
+    # Number of messages kept in memory - older messages are only kept in the spill file
+
+    global _log
+
+    with _log_lock:
+        if _log_settings['pending'] > capacity:
+            _spill()
+
+        _log = deque(_log, maxlen=capacity)
+
+
+def set_log_file(filename, spill_every=1000):
+    # Messages are spilled to filename (appended, one line per message: sequence number, time and message as a JSON
+    # string) every spill_every messages and at exit, starting with those not spilled yet - or, with None, to a
+    # temporary file again, only when the buffer is full
+
+    with _log_lock:
+        _close_segment()
+
+        _log_settings['file'] = filename
+        _log_settings['spill_every'] = spill_every
+
+
+def is_traced(trace_level):
+    # For callers that need to do some work to prepare a debug message
+
+    return trace_level is None or trace_level in _trace_levels
+
+
 def set_trace_levels(trace_levels):
     global _trace_levels
 
-    _trace_levels = trace_levels
+    _trace_levels = set(trace_levels)
+
+
+def debug(msg, no_trace=False, trace_level=None, file='', send_to_screen=True, args=()):
+    # Filtered here already, as debug messages are mostly filtered out
 
+    if trace_level is not None and trace_level not in _trace_levels:
+        return
 
-def debug(msg, no_trace=False, trace_level=None, file='', send_to_screen=True):
-    _message('(debug) {}'.format(msg), no_trace=no_trace, trace_level=trace_level, file=file, send_to_screen=send_to_screen)
+    _message(msg, no_trace=no_trace, trace_level=trace_level, file=file, send_to_screen=send_to_screen, prefix='(debug) ', args=args)
 
 
 def dump_traceback(exception, send_to_screen=True):
@@ -67,21 +244,21 @@ def dump_traceback(exception, send_to_screen=True):
         traceback.print_exception(type(exception), exception, exception.__traceback__)
 
 
-def error(msg, no_trace=False, trace_level=None, file='', send_to_screen=True):
-    _message(' ** ERROR: {}'.format(msg), no_trace=no_trace, trace_level=trace_level, file=file, send_to_screen=send_to_screen)
+def error(msg, no_trace=False, trace_level=None, file='', send_to_screen=True, args=()):
+    _message(msg, no_trace=no_trace, trace_level=trace_level, file=file, send_to_screen=send_to_screen, prefix=' ** ERROR: ', args=args)
 
 
-def fatal(msg, no_trace=False, trace_level=None, file='', send_to_screen=True):
+def fatal(msg, no_trace=False, trace_level=None, file='', send_to_screen=True, args=()):
 
     traceback.print_stack()
 
-    _message(' ** FATAL ERROR: {}'.format(msg), no_trace=no_trace, trace_level=trace_level, file=file, send_to_screen=send_to_screen)
+    _message(msg, no_trace=no_trace, trace_level=trace_level, file=file, send_to_screen=send_to_screen, prefix=' ** FATAL ERROR: ', args=args)
     
     exit()
 
 
-def message(msg, no_trace=False, trace_level=None, file='', send_to_screen=True):
-    _message(msg, no_trace=no_trace, trace_level=trace_level, file=file, send_to_screen=send_to_screen)
+def message(msg, no_trace=False, trace_level=None, file='', send_to_screen=True, args=()):
+    _message(msg, no_trace=no_trace, trace_level=trace_level, file=file, send_to_screen=send_to_screen, args=args)
 
 
 def not_implemented(text, partial=False, fatal=False, trace_level=None, file='', send_to_screen=True):
@@ -120,8 +297,12 @@ def show_stopwatch(watch='stop watch', trace_level=None, file=''):
     _message('{}: {:.2f}s'.format(watch, _stop_watch[watch]['elapsed']), no_trace=True, trace_level=trace_level, file=file)
 
 
-def warning(msg, no_trace=False, trace_level=None, file='', archive_section='', send_to_screen=True):
-    _message(' * Warning: {}'.format(msg), no_trace=no_trace, trace_level=trace_level, file=file, send_to_screen=send_to_screen)
+def warning(msg, no_trace=False, trace_level=None, file='', archive_section='', send_to_screen=True, args=()):
+    if archive_section != '':
+        msg = _format(msg, args)
+        args = ()
+
+    _message(msg, no_trace=no_trace, trace_level=trace_level, file=file, send_to_screen=send_to_screen, prefix=' * Warning: ', args=args)
 
     if archive_section != '':
         if archive_section not in _warnings.keys():
@@ -1,14 +1,28 @@
 import fikTools.color as color
+from concurrent.futures import ProcessPoolExecutor
 import copy
+from fnmatch import fnmatch
+from functools import partial
+import hashlib
+from itertools import zip_longest
 import fikTools.log as log
-from fikTools.file import join as fk_join
+import os
+import pickle
+import re
+import traceback
+from types import BuiltinFunctionType, FunctionType, MethodType
+from weakref import WeakKeyDictionary
+from fikTools.file import join as fk_join, exists as fk_exists, load_json_file, load_text_file, mkdir, save_json_file, save_text_file
 
 # ReportLab
 
+from reportlab.pdfbase.pdfdoc import PDFImageXObject
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import cm, inch
 from reportlab.platypus import BaseDocTemplate
 from reportlab.platypus import Frame
+from reportlab.platypus import FrameBreak
+from reportlab.platypus import KeepInFrame
 from reportlab.platypus import PageBreak
 from reportlab.platypus import PageTemplate
 from reportlab.platypus import Paragraph
@@ -18,9 +32,11 @@ from reportlab.platypus.tableofcontents import TableOfContents
 
 # Fonts
 
+import reportlab
+import reportlab.pdfbase.ttfonts
 import reportlab.rl_config
 from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfbase.ttfonts import TTEncoding, TTFont, TTFontFace
 from reportlab.pdfbase.pdfmetrics import registerFontFamily
 
 # Styles
@@ -70,6 +86,15 @@ _font_sizes = {}
 
 _styles = {}
 
+# ParagraphStyle objects are shared between all callers asking for the same style, and must not be modified
+
+_style_cache = {}
+
+_style_cache_statistics = {
+    'hits': 0,
+    'misses': 0,
+}
+
 _document_sizes = {
     'A1': {
         'doc_width': 59.4 * cm,
@@ -185,8 +210,82 @@ _document_sizes = {
     }
 }
 
+_font_files = []
+
+_font_cache_directory = None
+
+# Fonts declared by init() but not parsed yet: font name -> (TTF file, font family)
+# They are registered with ReportLab the first time they are looked up (see _find_font_and_register)
+
+_lazy_fonts = {}
+
+_reportlab_find_font_and_register = pdfmetrics.findFontAndRegister
+
+# Background images, decoded and compressed once per process and shared by all the documents built by the process
+# (image file, modification time) -> PDFImageXObject
+
+_background_images = {}
+
 _init_done = False
 
+_init_parameters = None
+
+
+class _StoryStream(list):
+    # Flowables are pulled from the source only when the layout engine reaches them
+    # The list methods used by BaseDocTemplate.build (del, insert, slices) work on the flowables pulled so far
+
+    def __init__(self, head, source):
+        list.__init__(self, head)
+
+        self._source = iter(source)
+
+    def _pull(self):
+        if self._source is None:
+            return False
+
+        try:
+            self.append(next(self._source))
+
+            return True
+
+        except StopIteration:
+            self._source = None
+
+            return False
+
+    def __len__(self):
+        # handle_keepWithNext only looks at the first len() flowables, so complete any keepWithNext chain first
+
+        while list.__len__(self) == 0 or list.__getitem__(self, -1).getKeepWithNext():
+            if not self._pull():
+                break
+
+        return list.__len__(self)
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            while index >= list.__len__(self) and self._pull():
+                pass
+
+        return list.__getitem__(self, index)
+
+
+class _StoryStreamFactory:
+    # Stands for the story in multiBuild, which scans it for indexing flowables (only the ones in the head, such as
+    # the table of contents, are found) and then copies it with story[:] at the start of every pass
+
+    def __init__(self, head, factory):
+        self._head = head
+
+        self._factory = factory
+
+    def __iter__(self):
+        return iter(self._head)
+
+    def __getitem__(self, index):
+        return _StoryStream(self._head, self._factory())
+
 
 class DocTemplateAllowingToC(BaseDocTemplate):
 
@@ -260,6 +359,98 @@ class DocTemplateWithoutToC(BaseDocTemplate):
         self.addPageTemplates(page_template)
 
 
+class DocTemplateCardSheet(BaseDocTemplate):
+
+    def __init__(self, filename, sheet_size_code, card_size_code, crop_marks, background_image, **kw):
+        self.allowSplitting = 0
+
+        self.card_size_code = card_size_code
+
+        self.crop_marks = crop_marks
+
+        self.background_image = background_image
+
+        self.layout = _card_sheet_layout(sheet_size_code, card_size_code)
+
+        BaseDocTemplate.__init__(self, filename, pagesize=(_document_sizes[sheet_size_code]['doc_width'], _document_sizes[sheet_size_code]['doc_height']), **kw)
+
+        # One frame per card, laid out row by row from the top left corner of the sheet
+
+        card = _document_sizes[card_size_code]
+
+        frames = []
+
+        for (x, y) in self.layout['positions']:
+            frames.append(Frame(x + card['left_margin'], y + card['bottom_margin'], card['frame_width'], card['frame_height'], leftPadding=0, rightPadding=0, topPadding=0, bottomPadding=0, id='card_{}'.format(len(frames) + 1)))
+
+        self.addPageTemplates(PageTemplate(id='card sheet', frames=frames, onPage=_set_card_sheet_background))
+
+
+def _card_sheet_layout(sheet_size_code, card_size_code, crop_mark_length=0.4 * cm):
+    # As many cards as fit on the sheet, leaving room for the crop marks, with the grid centred on the sheet
+
+    sheet = _document_sizes[sheet_size_code]
+    card = _document_sizes[card_size_code]
+
+    columns = int((sheet['doc_width'] - 2 * crop_mark_length) // card['doc_width'])
+    rows = int((sheet['doc_height'] - 2 * crop_mark_length) // card['doc_height'])
+
+    if columns < 1 or rows < 1:
+        raise Exception('{} cards do not fit on a {} sheet'.format(card_size_code, sheet_size_code))
+
+    left = (sheet['doc_width'] - columns * card['doc_width']) / 2
+    bottom = (sheet['doc_height'] - rows * card['doc_height']) / 2
+
+    positions = []
+
+    for r in range(rows - 1, -1, -1):
+        for c in range(columns):
+            positions.append((left + c * card['doc_width'], bottom + r * card['doc_height']))
+
+    return {
+        'columns': columns,
+        'rows': rows,
+        'left': left,
+        'bottom': bottom,
+        'right': left + columns * card['doc_width'],
+        'top': bottom + rows * card['doc_height'],
+        'crop_mark_length': crop_mark_length,
+        'positions': positions,
+    }
+
+
+def _set_card_sheet_background(canvas, doc):
+    card = _document_sizes[doc.card_size_code]
+    layout = doc.layout
+
+    if doc.background_image is not None:
+        for (x, y) in layout['positions']:
+            canvas.saveState()
+            canvas.translate(x, y)
+            _draw_background_image(canvas, doc.background_image, card['doc_width'], card['doc_height'])
+            canvas.restoreState()
+
+    if doc.crop_marks:
+        canvas.saveState()
+
+        canvas.setLineWidth(0.25)
+        canvas.setStrokeColor(color.BLACK)
+
+        gap = layout['crop_mark_length'] / 4
+
+        for c in range(layout['columns'] + 1):
+            x = layout['left'] + c * card['doc_width']
+            canvas.line(x, layout['top'] + gap, x, layout['top'] + layout['crop_mark_length'])
+            canvas.line(x, layout['bottom'] - gap, x, layout['bottom'] - layout['crop_mark_length'])
+
+        for r in range(layout['rows'] + 1):
+            y = layout['bottom'] + r * card['doc_height']
+            canvas.line(layout['left'] - gap, y, layout['left'] - layout['crop_mark_length'], y)
+            canvas.line(layout['right'] + gap, y, layout['right'] + layout['crop_mark_length'], y)
+
+        canvas.restoreState()
+
+
 def _set_canvas_background(canvas, doc):
     if doc.number_pages and doc.page > 1:
         canvas.saveState()
@@ -271,7 +462,37 @@ def _set_canvas_background(canvas, doc):
         canvas.restoreState()
 
     if doc.background_image is not None:
-        canvas.drawImage(doc.background_image, 0, 0, width=_document_sizes[doc.page_size_code]['doc_width'], height=_document_sizes[doc.page_size_code]['doc_height'], mask=None)
+        _draw_background_image(canvas, doc.background_image, _document_sizes[doc.page_size_code]['doc_width'], _document_sizes[doc.page_size_code]['doc_height'])
+
+
+def _draw_background_image(canvas, image_file, width, height):
+    # Same as canvas.drawImage(image_file, 0, 0, width=width, height=height, mask=None), except that the image is only
+    # loaded the first time it is used in the process - the document then references it on every page
+
+    name = 'background_{}'.format(hashlib.sha1(os.path.abspath(image_file).encode('utf-8')).hexdigest())
+
+    reg_name = canvas._doc.getXObjectName(name)
+
+    if reg_name not in canvas._doc.idToObject:
+        key = (os.path.abspath(image_file), os.stat(image_file).st_mtime)
+
+        if key not in _background_images.keys():
+            _background_images[key] = PDFImageXObject(name, image_file, mask=None)
+
+        image = copy.copy(_background_images[key])
+
+        canvas._setXObjects(image)
+        canvas._doc.Reference(image, reg_name)
+        canvas._doc.addForm(name, image)
+
+    canvas._currentPageHasImages = 1
+
+    canvas.saveState()
+    canvas.scale(width, height)
+    canvas._code.append('/{} Do'.format(reg_name))
+    canvas.restoreState()
+
+    canvas._formsinuse.append(name)
 
 
 def _set_canvas_foreground(canvas, doc):
@@ -324,9 +545,79 @@ def _init_document_sizes():
         _document_sizes[page_size]['centre_y'] = (_document_sizes[page_size]['doc_height'] / 2)
 
 
+def _find_font_and_register(font_name):
+    # Replaces pdfmetrics.findFontAndRegister, which ReportLab calls whenever a font name is not registered yet
+
+    if font_name in _lazy_fonts.keys():
+        return load_font(font_name)
+
+    return _reportlab_find_font_and_register(font_name)
+
+
+def _font_cache_file(font_file):
+    stat = os.stat(font_file)
+
+    key = '{}|{}|{}|{}'.format(os.path.abspath(font_file), stat.st_size, stat.st_mtime, reportlab.Version)
+
+    return fk_join(_font_cache_directory, '{}.pickle'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+
+def _load_ttfont(font_name, font_file):
+    # Parsed font faces are kept in the font cache directory (if any), so that new processes do not parse them again
+    # The cache relies on ReportLab internals, so any problem with it falls back on parsing the font file
+
+    if _font_cache_directory is None:
+        return TTFont(font_name, font_file)
+
+    cache_file = _font_cache_file(font_file)
+
+    if fk_exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as source:
+                face_data = pickle.load(source)
+
+            face = TTFontFace.__new__(TTFontFace)
+            face.__dict__.update(face_data)
+            face._pdfScale = (lambda x: x) if face.unitsPerEm == 1000 else (lambda x, multiplier=1000 / face.unitsPerEm: x * multiplier)
+
+            font = TTFont.__new__(TTFont)
+            font.fontName = font_name
+            font.face = face
+            font.encoding = TTEncoding()
+            font.state = WeakKeyDictionary()
+            font._asciiReadable = reportlab.rl_config.ttfAsciiReadable
+            font.shapable = not any(fnmatch(font_name, pattern) for pattern in getattr(reportlab.pdfbase.ttfonts, 'unShapedFontGlob', []))  # As in TTFont.__init__
+
+            return font
+
+        except Exception as exception:
+            log.warning('could not use cached font {} for {}: {}'.format(cache_file, font_file, exception))
+
+    font = TTFont(font_name, font_file)
+
+    try:
+        mkdir(_font_cache_directory)
+
+        with open(cache_file, 'wb') as target:
+            pickle.dump({key: value for key, value in vars(font.face).items() if key != '_pdfScale'}, target, protocol=pickle.HIGHEST_PROTOCOL)
+
+    except Exception as exception:
+        log.warning('could not cache font {}: {}'.format(font_file, exception))
+
+    return font
+
+
+def _register_font_family(font):
+    registerFontFamily(font, normal=font, bold='{}Bold'.format(font), italic='{}Italic'.format(font), boldItalic='{}BoldItalic'.format(font))
+
+
 def _init_fonts(fonts_list, fonts_directory):
     # reportlab.rl_config.TTFSearchPath.append(get_config('fonts directory'))
 
+    # Font files are only parsed when a font is first used (see load_font)
+
+    pdfmetrics.findFontAndRegister = _find_font_and_register
+
     if 'Default' not in fonts_list.keys():
         fonts_list['Default'] = {
             '': 'Times New Roman.ttf',
@@ -337,10 +628,11 @@ def _init_fonts(fonts_list, fonts_directory):
 
     for font in fonts_list.keys():
         for font_type in fonts_list[font].keys():
-            pdfmetrics.registerFont(TTFont('{}{}'.format(font, font_type), fk_join(fonts_directory, fonts_list[font][font_type])))
+            _font_files.append(fk_join(fonts_directory, fonts_list[font][font_type]))
+            _lazy_fonts['{}{}'.format(font, font_type)] = (fk_join(fonts_directory, fonts_list[font][font_type]), font)
             # pdfmetrics.registerFont(TTFont('{}{}'.format(font, font_type), font_list[font][font_type]))
 
-        registerFontFamily(font, normal=font, bold='{}Bold'.format(font), italic='{}Italic'.format(font), boldItalic='{}BoldItalic'.format(font))
+        _register_font_family(font)
 
 
 def _init_styles(leading=1.2, space_before=0, space_after=0.3):
@@ -381,14 +673,31 @@ def _init_styles(leading=1.2, space_before=0, space_after=0.3):
             style['name_for_toc'] = style['name_for_toc'] if 'name_for_toc' in style.keys() else key
 
 
-def init(font_sizes, fonts_list, fonts_directory, styles, leading, space_before, space_after):
+def init(font_sizes, fonts_list, fonts_directory, styles, leading, space_before, space_after, font_cache_directory=None):
+    global _font_cache_directory
     global _init_done
     global _font_sizes
+    global _init_parameters
     global _styles
 
     if _init_done:
         return
 
+    # Keep an untouched copy of the parameters so that worker processes (see build_pdfs) can run the same initialisation
+
+    _init_parameters = copy.deepcopy({
+        'font_sizes': font_sizes,
+        'fonts_list': fonts_list,
+        'fonts_directory': fonts_directory,
+        'styles': styles,
+        'leading': leading,
+        'space_before': space_before,
+        'space_after': space_after,
+        'font_cache_directory': font_cache_directory,
+    })
+
+    _font_cache_directory = font_cache_directory
+
     # font_sizes is a basic dictionary, key is a descriptive string and value is a number (the size of the font)
 
     _font_sizes = copy.deepcopy(font_sizes)
@@ -401,6 +710,8 @@ def init(font_sizes, fonts_list, fonts_directory, styles, leading, space_before,
 
     _styles = copy.deepcopy(styles)
 
+    clear_style_cache()
+
     _init_styles(leading=leading, space_before=space_before, space_after=space_after)
 
     _init_document_sizes()
@@ -408,13 +719,173 @@ def init(font_sizes, fonts_list, fonts_directory, styles, leading, space_before,
     _init_done = True
 
 
+def _build_cache_file(cache_directory, target_file, extension='txt'):
+    return fk_join(cache_directory, '{}.{}'.format(hashlib.sha1(os.path.abspath(target_file).encode('utf-8')).hexdigest(), extension))
+
+
+def _configuration_fingerprint():
+    # Styles, font sizes and registered font files (path, size and modification time)
+
+    digest = hashlib.sha256()
+
+    digest.update(repr(sorted(_font_sizes.items())).encode('utf-8'))
+
+    for category in sorted(_styles.keys()):
+        for key in sorted(_styles[category].keys()):
+            digest.update(repr((category, key, sorted(_styles[category][key].items(), key=lambda x: x[0]))).encode('utf-8'))
+
+    for font_file in _font_files:
+        digest.update(repr(_file_state(font_file)).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def _file_state(filename):
+    # Files used by a document are identified by their path, size and modification time
+
+    if fk_exists(filename):
+        stat = os.stat(filename)
+        return filename, stat.st_size, stat.st_mtime
+
+    return filename, None
+
+
+# Attributes of flowables holding the path of a file they read (such as reportlab.platypus.Image), and images inserted
+# in paragraphs
+
+_fingerprint_file_attributes = ['filename', 'fileName', '_file']
+
+_paragraph_image_pattern = re.compile(r'<img[^>]*\bsrc\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
+
+
+def _fingerprint(value, digest, seen):
+    # Feeds a stable representation of a story element into the digest
+    # Objects met again (such as shared styles) are referred to by the order in which they were first met, which is the
+    # same from one process to the next - objects which cannot be described reliably fall back on their id, so that they
+    # never match a previous build
+
+    if value is None or isinstance(value, (str, int, float, bool, bytes)):
+        digest.update(repr(value).encode('utf-8'))
+
+    elif isinstance(value, (list, tuple)):
+        digest.update('{}['.format(len(value)).encode('utf-8'))
+        for item in value:
+            _fingerprint(item, digest, seen)
+        digest.update(b']')
+
+    elif isinstance(value, dict):
+        digest.update('{}{{'.format(len(value)).encode('utf-8'))
+        for key in sorted(value.keys(), key=repr):
+            digest.update(repr(key).encode('utf-8'))
+            _fingerprint(value[key], digest, seen)
+        digest.update(b'}')
+
+    elif id(value) in seen:
+        digest.update('<seen {}>'.format(seen[id(value)]).encode('utf-8'))
+
+    elif isinstance(value, Paragraph):
+        seen[id(value)] = len(seen)
+        digest.update(b'Paragraph')
+        _fingerprint(value.text, digest, seen)
+        _fingerprint(value.style, digest, seen)
+
+        for image_file in _paragraph_image_pattern.findall(value.text):
+            digest.update(repr(_file_state(image_file)).encode('utf-8'))
+
+    elif isinstance(value, FunctionType):
+        # Functions are described by their name and code - except lambdas and local functions, which several functions
+        # can share the name of
+
+        if '<lambda>' in value.__qualname__ or '<locals>' in value.__qualname__:
+            digest.update('<function {}>'.format(id(value)).encode('utf-8'))
+        else:
+            digest.update('<function {}.{}>'.format(value.__module__, value.__qualname__).encode('utf-8'))
+            digest.update(value.__code__.co_code)
+            _fingerprint(value.__defaults__, digest, seen)
+
+    elif isinstance(value, MethodType):
+        digest.update(b'<method>')
+        _fingerprint(value.__func__, digest, seen)
+        _fingerprint(value.__self__, digest, seen)
+
+    elif isinstance(value, partial):
+        digest.update(b'<partial>')
+        _fingerprint([value.func, value.args, value.keywords], digest, seen)
+
+    elif isinstance(value, (BuiltinFunctionType, type)):
+        digest.update('<callable {}.{}>'.format(getattr(value, '__module__', None), value.__qualname__).encode('utf-8'))
+
+    elif callable(value) and not hasattr(value, '__dict__'):
+        digest.update('<callable {}>'.format(id(value)).encode('utf-8'))
+
+    elif hasattr(value, '__dict__'):
+        seen[id(value)] = len(seen)
+        digest.update(value.__class__.__name__.encode('utf-8'))
+        _fingerprint(vars(value), digest, seen)
+
+        for name in _fingerprint_file_attributes:
+            if isinstance(getattr(value, name, None), str):
+                digest.update(repr(_file_state(getattr(value, name))).encode('utf-8'))
+
+    else:
+        digest.update('<{} {}>'.format(value.__class__.__name__, id(value)).encode('utf-8'))
+
+
+def _story_fingerprint(story, parameters):
+    digest = hashlib.sha256()
+
+    digest.update(_configuration_fingerprint().encode('utf-8'))
+
+    seen = {}
+
+    _fingerprint(parameters, digest, seen)
+
+    for item in story:
+        _fingerprint(item, digest, seen)
+
+    return digest.hexdigest()
+
+
 def bolded(string):
     return '<b>{}</b>'.format(string)
 
 
-def build_pdf(target_file, story, page_size, title='', subtitle='', styles_for_toc=[], toc_title_style=None, create_toc=True, toc_title='Contents', number_pages=True, background_image=None, background_text=None):
+def build_pdf(target_file, story, page_size, title='', subtitle='', styles_for_toc=[], toc_title_style=None, create_toc=True, toc_title='Contents', number_pages=True, background_image=None, background_text=None, cache_directory=None, toc_cache_directory=None):
     check_init()
 
+    # story can be:
+    # - a list of flowables
+    # - an iterator or generator of flowables, consumed while the pages are laid out (documents without a table of
+    #   contents only, as building a table of contents takes several passes)
+    # - a callable returning a new iterator of flowables on every call, consumed lazily on every pass
+
+    story_factory = None
+
+    if callable(story):
+        story_factory = story
+
+    elif not isinstance(story, list):
+        if create_toc:
+            log.debug('{}: materialising the story, as the table of contents needs several passes', args=(target_file,), trace_level='pdf build', file=__file__)
+            story = list(story)
+        else:
+            story_iterator = iter(story)
+            story_factory = lambda: story_iterator
+
+    # When a cache directory is provided, skip the build if the story and configuration are unchanged since the last one
+
+    fingerprint = None
+
+    if cache_directory is not None and (story_factory is None or story_factory is story):
+        fingerprint = _story_fingerprint(story if story_factory is None else story_factory(), [page_size, title, subtitle, styles_for_toc, toc_title_style, create_toc, toc_title, number_pages, background_image, background_text, _file_state(background_image) if background_image is not None else None])
+
+        cache_file = _build_cache_file(cache_directory, target_file)
+
+        if fk_exists(target_file) and fk_exists(cache_file) and ''.join(load_text_file(cache_file)).strip() == fingerprint:
+            log.debug('{} is up to date', args=(target_file,), trace_level='pdf build cache', file=__file__)
+
+            return True
+
     full_story = []
 
     if title != '':
@@ -448,6 +919,12 @@ def build_pdf(target_file, story, page_size, title='', subtitle='', styles_for_t
             get_style(preset='level4', preset_category='table_of_contents'),
         ]
 
+        # Seed the table of contents with the entries of the previous build of this document
+        # multiBuild then only needs a second pass if the page numbers have changed
+
+        if toc_cache_directory is not None and fk_exists(_build_cache_file(toc_cache_directory, target_file, extension='toc.json')):
+            toc._entries = [tuple(entry) for entry in load_json_file(_build_cache_file(toc_cache_directory, target_file, extension='toc.json'))['entries']]
+
         full_story.append(Paragraph(toc_title, toc_title_style))
 
         full_story.append(toc)
@@ -468,16 +945,122 @@ def build_pdf(target_file, story, page_size, title='', subtitle='', styles_for_t
             bottomMargin=_document_sizes[page_size]['bottom_margin']
         )
 
-    for item in story:
-        full_story.append(item)
+    if story_factory is None:
+        for item in story:
+            full_story.append(item)
+    else:
+        full_story = _StoryStreamFactory(full_story, story_factory)
+
+    try:
+        passes = document.multiBuild(full_story, canvasmaker=canvas.Canvas)
+
+        log.debug('{} built in {} pass(es)', args=(target_file, passes), trace_level='pdf build', file=__file__)
+
+    except ValueError as exception:
+        log.warning('could not generate file {}'.format(target_file))
+        log.dump_traceback(exception)
+
+        return False
+
+    if create_toc and toc_cache_directory is not None:
+        save_json_file(_build_cache_file(toc_cache_directory, target_file, extension='toc.json'), {'entries': toc._entries}, create_directories=True)
+
+    if fingerprint is not None:
+        mkdir(cache_directory)
+        save_text_file(_build_cache_file(cache_directory, target_file), fingerprint)
+
+    return True
+
+
+def _build_pdf_job(job):
+    # Runs in a worker process - job is (target_file, story_factory, page_size, options)
+
+    target_file, story_factory, page_size, options = job
+
+    try:
+        if build_pdf(target_file, story_factory, page_size, **(options if options is not None else {})):
+            return target_file, None
+
+        return target_file, 'could not generate file {}'.format(target_file)
+
+    except Exception:
+        return target_file, traceback.format_exc()
+
+
+def _init_worker(init_parameters):
+    init(**init_parameters)
+
+
+def build_pdfs(jobs, processes=None):
+    # Builds several documents in parallel, one document per worker process
+    # jobs is a list of (target_file, story_factory, page_size, options) tuples, where story_factory is a picklable
+    # callable (e.g. a module-level function) returning the story, and options is a dictionary of build_pdf parameters
+    # Returns a dictionary of failed jobs: target file -> error message
+
+    check_init()
+
+    failures = {}
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(_init_parameters,)) as executor:
+        futures = [(job[0], executor.submit(_build_pdf_job, job)) for job in jobs]
+
+        for target_file, future in futures:
+            # Errors outside build_pdf (a job that cannot be sent to a worker, a worker that died) only fail their job
+
+            try:
+                target_file, error = future.result()
+
+            except Exception:
+                error = traceback.format_exc()
+
+            if error is not None:
+                log.warning('could not generate file {}'.format(target_file), no_trace=True)
+                failures[target_file] = error
+
+    return failures
+
+
+def _card_sheet_story(cards, card_size):
+    # Each card is shrunk to fit its frame if needed, so that it never spills over the next card
+
+    card = _document_sizes[card_size]
+
+    first = True
+
+    for card_story in cards:
+        if not first:
+            yield FrameBreak()
+
+        first = False
+
+        yield KeepInFrame(card['frame_width'], card['frame_height'], list(card_story), mode='shrink')
+
+
+def build_card_sheets(target_file, cards, sheet_size='A4', card_size='Playing Card', crop_marks=True, background_image=None):
+    # Imposes cards on sheets, as many per sheet as fit in a grid, in a single document
+    # cards is a list or iterable of card stories (each a list of flowables, as passed to build_pdf for a single card)
+
+    check_init()
+
+    document = DocTemplateCardSheet(
+        filename=target_file,
+        sheet_size_code=sheet_size,
+        card_size_code=card_size,
+        crop_marks=crop_marks,
+        background_image=background_image,
+    )
 
     try:
-        document.multiBuild(full_story, canvasmaker=canvas.Canvas)
+        document.build(_StoryStream([], _card_sheet_story(cards, card_size)), canvasmaker=canvas.Canvas)
 
     except ValueError as exception:
         log.warning('could not generate file {}'.format(target_file))
         log.dump_traceback(exception)
 
+        return False
+
+    return True
+
 
 def check_init():
     global _init_done
@@ -517,7 +1100,61 @@ def get_font_size(size):
     return _font_sizes[size] if size in _font_sizes.keys() else (_font_sizes[''] if '' in _font_sizes.keys() else _default_font_size)
 
 
+def clear_style_cache():
+    _style_cache.clear()
+
+    _style_cache_statistics['hits'] = 0
+    _style_cache_statistics['misses'] = 0
+
+
+def load_font(font_name):
+    # Parses and registers a font declared by init(), if this has not been done yet
+
+    if font_name not in _lazy_fonts.keys():
+        return pdfmetrics.getFont(font_name)
+
+    font_file, family = _lazy_fonts.pop(font_name)
+
+    font = _load_ttfont(font_name, font_file)
+
+    pdfmetrics.registerFont(font)
+
+    # Registering a TrueType font resets the mappings of its name, so set its family up again
+
+    _register_font_family(family)
+
+    return font
+
+
+def get_style_cache_statistics():
+    return dict(_style_cache_statistics, size=len(_style_cache))
+
+
 def get_style(preset='', preset_category='default', size=None, bold=None, italics=None, foreground=None, background=None, alignment=None):
+    key = (preset, preset_category, size, bold, italics, foreground, background, alignment)
+
+    try:
+        style = _style_cache.get(key)
+
+    except TypeError:
+        # Unhashable colour values cannot be cached
+        return _new_style(preset, preset_category, size, bold, italics, foreground, background, alignment)
+
+    if style is not None:
+        _style_cache_statistics['hits'] += 1
+
+        return style
+
+    _style_cache_statistics['misses'] += 1
+
+    style = _new_style(preset, preset_category, size, bold, italics, foreground, background, alignment)
+
+    _style_cache[key] = style
+
+    return style
+
+
+def _new_style(preset, preset_category, size, bold, italics, foreground, background, alignment):
     global _alignment
     global _font_sizes
     global _styles
@@ -631,10 +1268,10 @@ def table(data, box=False, grid=True, row_heights=None, valign='top'):
             vertical_span = 1 if 'vertical span' not in column.keys() else column['vertical span']
 
             if 'line above' in column.keys() and column['line above']:
-                table_style.append(('LINEABOVE', (c, r), (c + horizontal_span - 1, r + vertical_span - 1), 0.5, fikTools.colorBLACK))
+                table_style.append(('LINEABOVE', (c, r), (c + horizontal_span - 1, r + vertical_span - 1), 0.5, color.BLACK))
 
             if 'line below' in column.keys() and column['line below']:
-                table_style.append(('LINEBELOW', (c, r), (c + horizontal_span - 1, r + vertical_span - 1), 0.5, fikTools.colorBLACK))
+                table_style.append(('LINEBELOW', (c, r), (c + horizontal_span - 1, r + vertical_span - 1), 0.5, color.BLACK))
 
             if 'horizontal shift' in column.keys():
                 c += column['horizontal shift']
@@ -671,6 +1308,127 @@ def table(data, box=False, grid=True, row_heights=None, valign='top'):
     return t
 
 
+def _coalesce_cell_commands(commands):
+    # commands are (command, (c0, r0), (c1, r1), *arguments) tuples, generated in row order, one per cell
+    # Adjacent cells sharing the same command and arguments are merged into a single range, first along the rows,
+    # then down the columns
+
+    row_runs = []
+
+    for command in commands:
+        if len(row_runs) > 0:
+            previous = row_runs[-1]
+
+            if previous[0] == command[0] and previous[3:] == command[3:] and previous[1][1] == command[1][1] and previous[2][1] == command[2][1] and previous[2][0] + 1 == command[1][0]:
+                row_runs[-1] = (previous[0], previous[1], command[2]) + previous[3:]
+                continue
+
+        row_runs.append(command)
+
+    result = []
+    open_ranges = {}
+
+    for command in row_runs:
+        key = (command[0], command[1][0], command[2][0], command[3:])
+
+        if key in open_ranges:
+            index = open_ranges[key]
+            previous = result[index]
+
+            if previous[2][1] + 1 == command[1][1]:
+                result[index] = (previous[0], previous[1], (previous[2][0], command[2][1])) + previous[3:]
+                continue
+
+        open_ranges[key] = len(result)
+        result.append(command)
+
+    return result
+
+
+def table_from_columns(columns, box=False, grid=True, row_heights=None, valign='top'):
+    # Same as table_from_rows, with the data provided as a list of columns - shorter columns are padded with empty
+    # cells, as rows are in table_from_rows
+
+    return table_from_rows(list(zip_longest(*columns, fillvalue='')), box=box, grid=grid, row_heights=row_heights, valign=valign)
+
+
+def table_from_rows(data, box=False, grid=True, row_heights=None, valign='top'):
+    # Builds the same table as table(), but faster on large tables:
+    # - rows can be tuples, and cells can be either table_entry() dictionaries or ready-made values (text or flowables)
+    # - 1x1 spans are not generated, and identical cell commands (backgrounds, lines) are merged into ranges
+
+    table_style = default_table_style()
+
+    if box:
+        table_style.append(('BOX', (0, 0), (-1, -1), 0.5, color.BLACK))
+
+    if grid:
+        table_style.append(('GRID', (0, 0), (-1, -1), 0.5, color.BLACK))
+
+    table_style.append(('VALIGN', (0, 0), (-1, -1), valign.upper()))
+
+    # Find the table's dimensions
+
+    max_column = 0
+    for row in data:
+        c = 0
+        for column in row:
+            c += column.get('horizontal span', 1) if isinstance(column, dict) else 1
+        if c > max_column:
+            max_column = c
+
+    result = [[''] * max_column for r in range(len(data))]
+
+    cell_commands = []
+    span_commands = []
+
+    # Now fill the blanks
+
+    for r, row in enumerate(data):
+        c = 0
+        for column in row:
+            if not isinstance(column, dict):
+                result[r][c] = column
+                c += 1
+                continue
+
+            horizontal_span = column.get('horizontal span', 1)
+            vertical_span = column.get('vertical span', 1)
+
+            if column.get('line above'):
+                cell_commands.append(('LINEABOVE', (c, r), (c + horizontal_span - 1, r + vertical_span - 1), 0.5, color.BLACK))
+
+            if column.get('line below'):
+                cell_commands.append(('LINEBELOW', (c, r), (c + horizontal_span - 1, r + vertical_span - 1), 0.5, color.BLACK))
+
+            c += column.get('horizontal shift', 0)
+
+            if column.get('text override') is not None:
+                result[r][c] = column['text override']
+            else:
+                result[r][c] = Paragraph(
+                    column['text'],
+                    style=get_style(preset=column['style'],
+                                    preset_category=column['style_category'],
+                                    foreground=column.get('foreground'),
+                                    background=column.get('background'),
+                                    )
+                )
+
+            if horizontal_span != 1 or vertical_span != 1:
+                span_commands.append(('SPAN', (c, r), (c + horizontal_span - 1, r + vertical_span - 1)))
+
+            if 'background' in column:
+                cell_commands.append(('BACKGROUND', (c, r), (c + horizontal_span - 1, r + vertical_span - 1), column['background']))
+
+            c += horizontal_span
+
+    table_style += span_commands
+    table_style += _coalesce_cell_commands(cell_commands)
+
+    return Table(result, style=table_style, rowHeights=row_heights)
+
+
 def table_entry(text, style=None, foreground='#000000', background='#ffffff', horizontal_span=1, vertical_span=1, line_above=None, line_below=None, text_override=None, horizontal_shift=0, page_colour_scheme=None):
 
     if style is not None: